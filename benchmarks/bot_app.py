@@ -0,0 +1,36 @@
+"""Loads the bot against local stub servers and a throwaway SQLite database.
+
+The environment is configured before tg_bot is imported, because the package reads its configuration at import time.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(bot_api_url, geo_url=None, weather_url=None, database_uri=None, **env):
+    # Points the bot at the given stub URLs, imports the Flask app and creates the tables. Extra keyword arguments are
+    # set as environment variables, e.g. DISPATCH_MODE='queue'. It returns the app and the db.
+    if database_uri is None:
+        database_uri = f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}'
+    os.environ.update({
+        'SQLALCHEMY_DATABASE_URI': database_uri,
+        'BOT_TOKEN': 'TEST',
+        'TG_BASE_URL': f'{bot_api_url}/bot',
+        'TG_FILE_URL': f'{bot_api_url}/file/bot',
+        'GEO_URL': geo_url or f'{bot_api_url}/geo',
+        'WEATHER_URL': weather_url or f'{bot_api_url}/weather',
+        'COMMANDS_STATE_FILE': os.path.join(tempfile.mkdtemp(), 'commands.json'),
+        # The stubs have no flood limits, so the outbound rate limiter is off unless a run turns it on.
+        'SENDER_GLOBAL_RATE': '0',
+        'SENDER_CHAT_RATE': '0',
+    })
+    os.environ.update({key: str(value) for key, value in env.items()})
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from tg_bot import app, db
+    with app.app_context():
+        # Only the primary; replicas get the schema by replication.
+        db.create_all(bind_key=None)
+    return app, db
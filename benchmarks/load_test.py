@@ -0,0 +1,321 @@
+"""Offline load test replaying synthetic Telegram updates through the webhook.
+
+Generates a mix of message and callback_query updates covering every MessageHandler command, drives them through the
+Flask app in-process (test client) and/or over HTTP, with the Bot API and the weather/geo APIs replaced by local
+stubs with configurable latency. The report is JSON: throughput, p50/p95/p99 latency and database queries per
+command, so runs can be compared across commits.
+
+    python benchmarks/load_test.py --users 50 --updates-per-user 40 --mode inprocess http --output report.json
+"""
+import argparse
+import json
+import logging
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+from bot_app import ROOT, load_app
+from stubs import StubBotAPI, StubWeatherAPI
+
+CITIES = ['Kyiv', 'Lviv', 'Odesa', 'Kharkiv', 'Dnipro', 'Warsaw', 'Berlin', 'Paris']
+FIRST_NAMES = ['Ann', 'Bob', 'Olena', 'Taras', 'Iryna', 'Max', 'Sofia', 'Petro']
+LAST_NAMES = ['Smith', 'Shevchenko', 'Kovalenko', 'Bondar', 'Melnyk', 'Brown', 'Tkachenko', 'Lysenko']
+PRODUCTS = ['milk', 'eggs', 'bread', 'butter', 'apples', 'cheese', 'coffee', 'tea', 'rice', 'pasta']
+
+# Relative frequency of the commands sent after a user's setup; reads dominate as they do in production.
+WEIGHTS = {
+    '/show_items': 12, '/add_item': 8, '/remove_item': 3, '/list': 6, '/status': 5, '/show': 5, '/find': 5,
+    '/add': 4, '/delete': 2, '/weather': 4, 'callback:/weather_city': 4, 'callback:/show_items': 3,
+    'callback:/contacts_page': 2, 'callback:/items_page': 3, '/lists': 3, '/edit_list': 1, '/create_list': 1,
+    '/remove_list': 1, '/subscribe_weather': 1, '/unsubscribe_weather': 1, '/import': 1, '/export': 1, '/commands': 1,
+    '/start': 1,
+}
+
+# The file sent with /import, served by the Bot API stub under this file ID.
+IMPORT_FILE_ID = 'contacts-csv'
+IMPORT_FILE = ('first_name,last_name,phone_number\n' + ''.join(
+    f'{first_name},{last_name},+38063{i:07d}\n'
+    for i, (first_name, last_name) in enumerate(zip(FIRST_NAMES, reversed(LAST_NAMES))))).encode()
+
+
+class UpdateFactory:
+    # This is a class that builds message and callback_query updates with increasing update IDs.
+    def __init__(self, first_update_id=1):
+        self.update_id = first_update_id
+        self._lock = threading.Lock()
+
+    def _next_id(self):
+        with self._lock:
+            self.update_id += 1
+            return self.update_id
+
+    def message(self, user_id, text):
+        update_id = self._next_id()
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'language_code': 'en'},
+                'chat': {'id': user_id, 'type': 'private'},
+                'date': int(time.time()),
+                'text': text,
+            },
+        }
+
+    def document(self, user_id, file_id, file_name, mime_type, file_size, caption=None):
+        update = self.message(user_id, None)
+        del update['message']['text']
+        update['message']['document'] = {'file_id': file_id, 'file_name': file_name, 'mime_type': mime_type,
+                                         'file_size': file_size}
+        if caption:
+            update['message']['caption'] = caption
+        return update
+
+    def callback(self, user_id, callback_type, update_id=None, **data):
+        # The callback data is encoded as the bot encodes its buttons, so the app has to be loaded first.
+        from tg_bot import callback_codec
+        update_id = update_id or self._next_id()
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'language_code': 'en'},
+                'message': {'message_id': update_id, 'chat': {'id': user_id, 'type': 'private'}},
+                'data': callback_codec.encode(callback_type, **data),
+            },
+        }
+
+    def deferred_callback(self, user_id, callback_type, resolve):
+        # Returns a function building a callback update when it is sent, for data which is only known once the earlier
+        # updates of the user have been handled, e.g. the ID of a list. The update ID is taken now, so the updates of
+        # the user keep their order.
+        update_id = self._next_id()
+        return lambda: self.callback(user_id, callback_type, update_id, **resolve())
+
+
+def list_id(user_id, list_name):
+    # Returns the ID of a shop list, which the bot puts into the buttons of the list pages.
+    from tg_bot import app
+    from tg_bot.models import ShopList
+    with app.app_context():
+        return ShopList.query.with_entities(ShopList.id).filter_by(user_id=user_id, list_name=list_name).scalar()
+
+
+def user_session(factory, rnd, user_id, count):
+    # Returns the (command, update) pairs of one user: a setup creating a list and some contacts, then count updates
+    # drawn from WEIGHTS against the state built so far. An update may be a function returning the update, which is
+    # called right before the update is sent.
+    lists = [f'list{user_id}']
+    contacts = []
+    session = [('/start', factory.message(user_id, '/start')),
+               ('/create_list', factory.message(user_id, f'/create_list {lists[0]}')),
+               ('/add_item', factory.message(user_id, f'/add_item {lists[0]} {", ".join(rnd.sample(PRODUCTS, 4))}'))]
+    for _ in range(3):
+        contact = (rnd.choice(FIRST_NAMES), f'{rnd.choice(LAST_NAMES)}{len(contacts)}')
+        contacts.append(contact)
+        text = f'/add {contact[0]} {contact[1]} +38050{rnd.randrange(10 ** 7):07d}'
+        session.append(('/add', factory.message(user_id, text)))
+    commands, weights = zip(*WEIGHTS.items())
+    while len(session) < count:
+        command = rnd.choices(commands, weights)[0]
+        list_name = rnd.choice(lists) if lists else f'list{user_id}'
+        if command == '/show_items':
+            update = factory.message(user_id, f'/show_items {list_name}')
+        elif command == '/add_item':
+            items = ', '.join(rnd.sample(PRODUCTS, rnd.randint(1, 3)))
+            update = factory.message(user_id, f'/add_item {list_name} {items}')
+        elif command == '/remove_item':
+            update = factory.message(user_id, f'/remove_item {list_name} {rnd.choice(PRODUCTS)}')
+        elif command == '/create_list':
+            lists.append(f'list{user_id}x{len(session)}')
+            update = factory.message(user_id, f'/create_list {lists[-1]}')
+        elif command == '/edit_list':
+            new_name = f'list{user_id}e{len(session)}'
+            update = factory.message(user_id, f'/edit_list {list_name} {new_name}')
+            lists = [new_name if name == list_name else name for name in lists]
+        elif command == '/remove_list':
+            if len(lists) < 2:
+                continue
+            lists.remove(list_name)
+            update = factory.message(user_id, f'/remove_list {list_name}')
+        elif command == '/add':
+            contact = (rnd.choice(FIRST_NAMES), f'{rnd.choice(LAST_NAMES)}{len(session)}')
+            contacts.append(contact)
+            update = factory.message(user_id, f'/add {contact[0]} {contact[1]} +38067{rnd.randrange(10 ** 7):07d}')
+        elif command in ('/show', '/delete'):
+            if not contacts:
+                continue
+            contact = rnd.choice(contacts)
+            if command == '/delete':
+                contacts.remove(contact)
+            update = factory.message(user_id, f'{command} {contact[0]} {contact[1]}')
+        elif command == '/find':
+            update = factory.message(user_id, f'/find {rnd.choice(FIRST_NAMES + LAST_NAMES)[:rnd.randint(2, 5)]}')
+        elif command == '/weather':
+            update = factory.message(user_id, f'/weather {rnd.choice(CITIES)}')
+        elif command == 'callback:/weather_city':
+            update = factory.callback(user_id, '/weather_city', lat=round(rnd.uniform(40, 60), 4),
+                                      lon=round(rnd.uniform(10, 40), 4))
+        elif command == 'callback:/show_items':
+            update = factory.callback(user_id, '/show_items', list_name=list_name)
+        elif command == 'callback:/contacts_page':
+            update = factory.callback(user_id, '/contacts_page', s=0, a=0)
+        elif command == 'callback:/items_page':
+            update = factory.deferred_callback(user_id, '/items_page',
+                                               lambda name=list_name: {'l': list_id(user_id, name), 'a': 0})
+        elif command == '/subscribe_weather':
+            update = factory.message(user_id, f'/subscribe_weather {rnd.choice(CITIES)}')
+        elif command == '/unsubscribe_weather':
+            update = factory.message(user_id, f'/unsubscribe_weather {rnd.choice(CITIES + [""])}'.rstrip())
+        elif command == '/import':
+            update = factory.document(user_id, IMPORT_FILE_ID, 'contacts.csv', 'text/csv', len(IMPORT_FILE),
+                                      rnd.choice(['/import', None]))
+        elif command == '/export':
+            update = factory.message(user_id, f'/export {rnd.choice(["csv", "vcard"])}')
+        else:
+            update = factory.message(user_id, command)
+        session.append((command, update))
+    return session
+
+
+def generate(users, updates_per_user, seed, first_user_id=1000, first_update_id=1):
+    # Returns one session of (command, update) pairs per user.
+    rnd = random.Random(seed)
+    factory = UpdateFactory(first_update_id)
+    return [user_session(factory, rnd, first_user_id + i, updates_per_user) for i in range(users)]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+def drive(post, sessions, concurrency):
+    # Posts every session on its own worker, so the updates of one user stay in order, and returns the latencies per
+    # command and the elapsed time.
+    latencies = {}
+    lock = threading.Lock()
+
+    def run_session(session):
+        for command, update in session:
+            if callable(update):
+                update = update()
+            start = time.perf_counter()
+            post(update)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.setdefault(command, []).append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run_session, sessions))
+    return latencies, time.perf_counter() - start
+
+
+def run_mode(mode, app, sessions, concurrency):
+    if mode == 'inprocess':
+        client = app.test_client()
+
+        def post(update):
+            response = client.post('/', json=update)
+            assert response.status_code == 200, response.status_code
+
+        return drive(post, sessions, concurrency)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/'
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def post(update):
+        session.post(url, json=update).raise_for_status()
+
+    try:
+        return drive(post, sessions, concurrency)
+    finally:
+        server.shutdown()
+
+
+def report(mode, latencies, elapsed, command_stats):
+    total = sum(len(values) for values in latencies.values())
+    commands = {}
+    for command, values in sorted(latencies.items()):
+        commands[command] = {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'db_queries': command_stats.get(command, {}).get('queries'),
+        }
+    return {
+        'mode': mode,
+        'updates': total,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(total / elapsed, 1),
+        'commands': commands,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--updates-per-user', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mode', nargs='+', choices=['inprocess', 'http'], default=['inprocess', 'http'])
+    parser.add_argument('--bot-api-latency', type=float, default=0.0, help='seconds')
+    parser.add_argument('--weather-latency', type=float, default=0.0, help='seconds')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    bot_api = StubBotAPI(latency=args.bot_api_latency).start()
+    bot_api.add_file(IMPORT_FILE_ID, IMPORT_FILE)
+    weather_api = StubWeatherAPI(latency=args.weather_latency).start()
+    app, _ = load_app(bot_api.url, geo_url=f'{weather_api.url}/geo', weather_url=f'{weather_api.url}/weather')
+    from tg_bot.instrumentation import command_stats
+    from tg_bot.metrics import webhook_replies
+    from tg_bot.sender import sender
+
+    results = {
+        'revision': git_revision(),
+        'config': vars(args),
+        'runs': [],
+    }
+    for i, mode in enumerate(args.mode):
+        # Every mode gets its own users and update IDs, so earlier runs neither collide with nor warm up later ones.
+        sessions = generate(args.users, args.updates_per_user, args.seed,
+                            first_user_id=1000 + i * 1_000_000, first_update_id=i * 100_000_000)
+        command_stats.stats.clear()
+        latencies, elapsed = run_mode(mode, app, sessions, args.concurrency)
+        results['runs'].append(report(mode, latencies, elapsed, command_stats.snapshot()))
+    sender.join()
+    results['bot_api_calls'] = bot_api.calls
+    results['webhook_replies'] = webhook_replies.values.get((), 0)
+    results['upstream_calls'] = weather_api.calls
+    bot_api.stop()
+    weather_api.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Lookup latency of the hot service queries with and without the composite indexes.
+
+Builds the shop_lists, items and contact_book tables in a temporary SQLite database, runs the
+(user_id, list_name), (list_id, name) and (user_id, first_name, last_name) lookups used by the services,
+then adds the indexes declared in tg_bot/models.py and runs the same lookups again.
+
+    python benchmarks/lookup_indexes.py --rows 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+SCHEMA = '''
+CREATE TABLE shop_lists (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, list_name VARCHAR(100) NOT NULL);
+CREATE TABLE items (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, list_id INTEGER NOT NULL);
+CREATE TABLE contact_book (id INTEGER PRIMARY KEY, first_name VARCHAR(100) NOT NULL,
+                           last_name VARCHAR(100) NOT NULL, phone_number VARCHAR(20) NOT NULL,
+                           user_id INTEGER NOT NULL);
+'''
+
+INDEXES = '''
+CREATE UNIQUE INDEX uq_shop_lists_user_id_list_name ON shop_lists (user_id, list_name);
+CREATE INDEX ix_items_list_id_name ON items (list_id, name);
+CREATE UNIQUE INDEX uq_contact_book_user_id_first_name_last_name ON contact_book (user_id, first_name, last_name);
+'''
+
+QUERIES = {
+    'shop_list': 'SELECT id FROM shop_lists WHERE user_id = ? AND list_name = ? LIMIT 1',
+    'item': 'SELECT id FROM items WHERE list_id = ? AND name = ? LIMIT 1',
+    'contact': 'SELECT id FROM contact_book WHERE user_id = ? AND first_name = ? AND last_name = ? LIMIT 1',
+}
+
+
+def populate(conn, rows):
+    # Fills every table with the given number of rows, spread over rows / 100 users.
+    users = max(rows // 100, 1)
+    conn.executemany('INSERT INTO shop_lists (id, user_id, list_name) VALUES (?, ?, ?)',
+                     ((i, i % users, f'list{i}') for i in range(rows)))
+    conn.executemany('INSERT INTO items (id, name, list_id) VALUES (?, ?, ?)',
+                     ((i, f'item{i}', i % users) for i in range(rows)))
+    conn.executemany('INSERT INTO contact_book (id, first_name, last_name, phone_number, user_id) '
+                     'VALUES (?, ?, ?, ?, ?)',
+                     ((i, f'first{i}', f'last{i}', f'+380{i:09d}', i % users) for i in range(rows)))
+    conn.commit()
+    return users
+
+
+def measure(conn, rows, users, lookups):
+    # Returns the mean latency in microseconds of every lookup.
+    rnd = random.Random(rows)
+    keys = [rnd.randrange(rows) for _ in range(lookups)]
+    params = {
+        'shop_list': [(i % users, f'list{i}') for i in keys],
+        'item': [(i % users, f'item{i}') for i in keys],
+        'contact': [(i % users, f'first{i}', f'last{i}') for i in keys],
+    }
+    result = {}
+    for name, sql in QUERIES.items():
+        start = time.perf_counter()
+        for args in params[name]:
+            conn.execute(sql, args).fetchone()
+        result[name] = round((time.perf_counter() - start) / lookups * 1e6, 2)
+    return result
+
+
+def run(rows, lookups):
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+        conn.executescript(SCHEMA)
+        users = populate(conn, rows)
+        before = measure(conn, rows, users, lookups)
+        conn.executescript(INDEXES)
+        conn.execute('ANALYZE')
+        after = measure(conn, rows, users, lookups)
+        conn.close()
+    return {'rows': rows, 'lookups': lookups, 'before_us': before, 'after_us': after}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+    for rows in args.rows:
+        print(json.dumps(run(rows, args.lookups)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Throughput of long polling ingestion against webhook ingestion.
+
+Both modes handle the same mix of updates against a stub Bot API and a SQLite database. Webhook mode POSTs every
+update to the Flask app served over HTTP; polling mode lets UpdatePoller pull the updates from the stub in batches.
+
+    python benchmarks/polling_vs_webhook.py --updates 2000 --users 50 --concurrency 8
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+from bot_app import load_app
+from stubs import StubBotAPI
+
+COMMANDS = [
+    '/create_list groceries',
+    '/add_item groceries milk, eggs, bread',
+    '/show_items groceries',
+    '/add Ann Smith +380501234567',
+    '/status',
+    '/list',
+    '/show Ann Smith',
+]
+
+
+def make_updates(count, users, first_user_id, first_update_id):
+    # Returns message updates cycling through COMMANDS for every user.
+    updates = []
+    for i in range(count):
+        user_id = first_user_id + i % users
+        text = COMMANDS[(i // users) % len(COMMANDS)]
+        updates.append({
+            'update_id': first_update_id + i,
+            'message': {
+                'message_id': i,
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'language_code': 'en'},
+                'chat': {'id': user_id, 'type': 'private'},
+                'date': int(time.time()),
+                'text': text,
+            },
+        })
+    return updates
+
+
+def run_webhook(app, updates, concurrency):
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/'
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda update: session.post(url, json=update).raise_for_status(), updates))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    return elapsed
+
+
+def run_polling(stub, updates, concurrency):
+    from tg_bot.polling import UpdatePoller
+    poller = UpdatePoller(timeout=1, concurrency=concurrency)
+    thread = threading.Thread(target=poller.run, daemon=True)
+    start = time.perf_counter()
+    stub.push_updates(updates)
+    thread.start()
+    while poller.processed + poller.failed < len(updates):
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    poller.stop()
+    thread.join()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help='Bot API latency in seconds')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    stub = StubBotAPI(latency=args.latency).start()
+    app, _ = load_app(stub.url)
+    results = {}
+    for mode, first_id in (('webhook', 1), ('polling', 1_000_000)):
+        updates = make_updates(args.updates, args.users, first_id, first_id)
+        if mode == 'webhook':
+            elapsed = run_webhook(app, updates, args.concurrency)
+        else:
+            elapsed = run_polling(stub, updates, args.concurrency)
+        results[mode] = {
+            'updates': args.updates,
+            'seconds': round(elapsed, 3),
+            'updates_per_second': round(args.updates / elapsed, 1),
+        }
+    from tg_bot.sender import sender
+    sender.join()
+    results['bot_api_calls'] = stub.calls
+    stub.stop()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Per-row time and memory of reading items and contacts as ORM objects and as column projections.
+
+Fills one shop list and one contact book with the given numbers of rows in a temporary SQLite database, then reads all
+of them the way the services used to (complete ORM objects) and the way they do now (only the needed columns, as
+tuples). Also times one page of /show_items resolved with a list lookup followed by an item query against the single
+joined query of ShopWizardService.list_items_page.
+
+    python benchmarks/read_projection.py --rows 1000 10000 100000
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from bot_app import load_app
+from stubs import StubBotAPI
+
+
+def measure(db, read, rows, repeat):
+    # Returns the best time and the peak memory of read() per row, in microseconds and bytes. The identity map is
+    # cleared before every read, so ORM objects are always built from scratch.
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        gc.collect()
+        start = time.perf_counter()
+        read()
+        timings.append(time.perf_counter() - start)
+    db.session.expunge_all()
+    gc.collect()
+    tracemalloc.start()
+    result = read()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    db.session.expunge_all()
+    return {'us_per_row': round(min(timings) / rows * 1e6, 3), 'bytes_per_row': round(peak / rows, 1)}
+
+
+def measure_page(db, read, repeat):
+    # Returns the mean time of one page read in microseconds.
+    db.session.expunge_all()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        read()
+        db.session.expunge_all()
+    return round((time.perf_counter() - start) / repeat * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--page-repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    bot_api = StubBotAPI().start()
+    app, db = load_app(bot_api.url)
+    from tg_bot.models import ContactBook, Item, ShopList, User
+    from tg_bot.services import ShopWizardService, keyset_page
+
+    results = []
+    with app.app_context():
+        for run, count in enumerate(args.rows):
+            user = User(id=1000 + run)
+            shop_list = ShopList(user_id=user.id, list_name='bench', item_count=count)
+            db.session.add_all([user, shop_list])
+            db.session.flush()
+            list_id, user_id = shop_list.id, user.id
+            db.session.execute(Item.__table__.insert(),
+                               [{'name': f'item{i}', 'list_id': list_id} for i in range(count)])
+            db.session.execute(ContactBook.__table__.insert(), [
+                {'first_name': f'first{i}', 'last_name': f'last{i}', 'phone_number': f'+380{i:09d}',
+                 'user_id': user_id} for i in range(count)
+            ])
+            db.session.commit()
+
+            def items_orm():
+                return [(item.id, item.name) for item in Item.query.filter_by(list_id=list_id).order_by(Item.id)]
+
+            def items_projection():
+                return db.session.query(Item.id, Item.name).filter(Item.list_id == list_id).order_by(Item.id).all()
+
+            def contacts_orm():
+                return [(contact.id, contact.first_name, contact.last_name)
+                        for contact in ContactBook.query.filter_by(user_id=user_id).order_by(ContactBook.id)]
+
+            def contacts_projection():
+                return db.session.query(ContactBook.id, ContactBook.first_name, ContactBook.last_name) \
+                    .filter(ContactBook.user_id == user_id).order_by(ContactBook.id).all()
+
+            def page_two_queries():
+                found = ShopList.query.filter_by(user_id=user_id, list_name='bench').first()
+                query = db.session.query(Item.id, Item.name).filter(Item.list_id == found.id)
+                return keyset_page(query, Item.id)
+
+            def page_joined():
+                # The handler has already resolved the user, only its ID is used.
+                return ShopWizardService.list_items_page(SimpleNamespace(id=user_id), ShopList.list_name == 'bench')
+
+            results.append({
+                'rows': count,
+                'items_orm': measure(db, items_orm, count, args.repeat),
+                'items_projection': measure(db, items_projection, count, args.repeat),
+                'contacts_orm': measure(db, contacts_orm, count, args.repeat),
+                'contacts_projection': measure(db, contacts_projection, count, args.repeat),
+                'page_two_queries_us': measure_page(db, page_two_queries, args.page_repeat),
+                'page_joined_us': measure_page(db, page_joined, args.page_repeat),
+            })
+    bot_api.stop()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
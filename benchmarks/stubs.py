@@ -0,0 +1,160 @@
+"""Local stand-ins for the Bot API, so the bot can be run and measured offline.
+
+StubBotAPI answers every Bot API method under /bot<token>/<method>. getUpdates serves the updates queued with
+push_updates() with the same offset and long polling semantics as Telegram, and files added with add_file() are served
+through getFile and /file/bot<token>/<file_path>; every other method is recorded and answered with a successful result.
+A fixed latency can be injected into every response.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    # This is a class that runs a threaded HTTP server on a free local port. Subclasses implement respond().
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._request_handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def respond(self, method, path, query, body):
+        # Returns the status code and the JSON body of the response, or bytes for a raw body.
+        raise NotImplementedError
+
+    def _request_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._handle(None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    # A multipart upload, e.g. sendDocument, is passed on undecoded.
+                    body = {'raw': raw}
+                self._handle(body)
+
+            def _handle(self, body):
+                path, _, query_string = self.path.partition('?')
+                query = dict(part.split('=', 1) for part in query_string.split('&') if '=' in part)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                status, payload = stub.respond(self.command, path, query, body)
+                raw = isinstance(payload, bytes)
+                data = payload if raw else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/octet-stream' if raw else 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class StubBotAPI(StubServer):
+    # This is a class that imitates the Bot API. Use f'{stub.url}/bot' as TG_BASE_URL.
+    MAX_POLL_WAIT = 1.0
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.updates = []
+        self.sent = []
+        self.files = {}
+        self._updates_changed = threading.Condition(self._lock)
+
+    def push_updates(self, updates):
+        # Queues updates for getUpdates.
+        with self._updates_changed:
+            self.updates.extend(updates)
+            self._updates_changed.notify_all()
+
+    def add_file(self, file_id, content):
+        # Makes the bytes available as the file with the given ID, as if a user had sent it to the bot.
+        self.files[file_id] = content
+
+    def respond(self, method, path, query, body):
+        if path.startswith('/file/'):
+            content = self.files.get(path.rsplit('/', 1)[-1])
+            return (200, content) if content is not None else (404, {'ok': False})
+        name = path.rsplit('/', 1)[-1]
+        self.record(name)
+        body = body or {}
+        if name == 'getFile':
+            if body.get('file_id') not in self.files:
+                return 400, {'ok': False, 'description': 'Bad Request: invalid file_id'}
+            file_path = f'documents/{body["file_id"]}'
+            return 200, {'ok': True, 'result': {'file_id': body['file_id'], 'file_path': file_path}}
+        if name == 'sendDocument':
+            with self._lock:
+                self.sent.append(body)
+            return 200, {'ok': True, 'result': {'message_id': len(self.sent)}}
+        if name == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(body)}
+        if name in ('sendMessage', 'editMessageText'):
+            with self._lock:
+                self.sent.append(body)
+            return 200, {'ok': True, 'result': {'message_id': len(self.sent), 'chat': {'id': body.get('chat_id')},
+                                                'text': body.get('text')}}
+        return 200, {'ok': True, 'result': True}
+
+    def _get_updates(self, body):
+        offset = body.get('offset')
+        limit = body.get('limit', 100)
+        deadline = time.monotonic() + min(body.get('timeout', 0), self.MAX_POLL_WAIT)
+        with self._updates_changed:
+            if offset is not None:
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self._updates_changed.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+
+class StubWeatherAPI(StubServer):
+    # This is a class that imitates the geocoding and the weather APIs. Use f'{stub.url}/geo' as GEO_URL and
+    # f'{stub.url}/weather' as WEATHER_URL.
+    def respond(self, method, path, query, body):
+        name = path.rsplit('/', 1)[-1]
+        self.record(name)
+        if name == 'geo':
+            city = query.get('name', 'City').replace('+', ' ')
+            seed = sum(map(ord, city))
+            return 200, {'results': [
+                {'name': city, 'country_code': code, 'latitude': round(seed % 90 + i * 0.5, 4),
+                 'longitude': round(seed % 180 + i * 0.5, 4)}
+                for i, code in enumerate(('UA', 'PL', 'DE'))
+            ]}
+        if name == 'weather':
+            latitude = float(query.get('latitude', 0))
+            return 200, {'current_weather': {'temperature': round(latitude % 30, 1), 'windspeed': 3.2,
+                                             'weathercode': 61 if int(latitude) % 2 else 0, 'rain': int(latitude) % 2}}
+        return 404, {'error': True}
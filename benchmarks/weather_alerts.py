@@ -0,0 +1,53 @@
+"""Upstream weather requests of a rain alert tick as the number of subscribers grows.
+
+Subscribes users to a fixed number of distinct locations against the stub weather API and runs one scheduler tick per
+subscriber count. The number of weather requests should follow the number of locations, not of subscribers.
+
+    python benchmarks/weather_alerts.py --subscribers 100 1000 10000 --locations 50
+"""
+import argparse
+import json
+
+from bot_app import load_app
+from stubs import StubBotAPI, StubWeatherAPI
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscribers', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--locations', type=int, default=50)
+    args = parser.parse_args()
+
+    bot_api = StubBotAPI().start()
+    weather_api = StubWeatherAPI().start()
+    app, db = load_app(bot_api.url, geo_url=f'{weather_api.url}/geo', weather_url=f'{weather_api.url}/weather',
+                       WEATHER_ALERTS_INTERVAL=60)
+    from tg_bot.models import User, WeatherSubscription
+    from tg_bot.scheduler import weather_alerts
+    from tg_bot.sender import sender
+    from tg_bot.services import WeatherService
+
+    results = []
+    with app.app_context():
+        for run, count in enumerate(args.subscribers):
+            db.session.query(WeatherSubscription).delete()
+            first_user_id = 1000 + run * 1_000_000
+            db.session.execute(User.__table__.insert(), [{'id': first_user_id + i} for i in range(count)])
+            db.session.execute(WeatherSubscription.__table__.insert(), [
+                {'user_id': first_user_id + i, 'city_name': f'City{i % args.locations}',
+                 'latitude': 40 + i % args.locations * 0.25, 'longitude': 20.0, 'is_raining': False}
+                for i in range(count)
+            ])
+            db.session.commit()
+            WeatherService.weather_cache.clear()
+            before = weather_api.calls.get('weather', 0)
+            stats = weather_alerts.run_once(slot=run)
+            sender.join()
+            results.append(dict(stats, weather_requests=weather_api.calls.get('weather', 0) - before))
+    bot_api.stop()
+    weather_api.stop()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
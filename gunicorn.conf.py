@@ -0,0 +1,66 @@
+"""Production server settings: gunicorn -c gunicorn.conf.py
+
+The app is imported once in the master process before the workers are forked, so the imported code and the
+configuration are shared copy-on-write. Every worker then drops the connections inherited from the master, opens its
+own database and HTTP connections before it accepts requests, and logs its cold-start time and RSS.
+
+One worker process is started by default. Several workers (WEB_CONCURRENCY) need the shared stores listed by
+tg_bot.warmup.process_local_settings(), otherwise the server refuses to start.
+"""
+import os
+import time
+
+CONFIG_LOADED = time.monotonic()
+
+wsgi_app = 'tg_bot:app'
+bind = os.getenv('BIND', '0.0.0.0:4242')
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+preload_app = True
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+
+def on_starting(server):
+    # Runs in the master before the workers are forked. Several workers with state kept in process memory would serve
+    # stale lists, reject callback tokens issued by another worker and handle redelivered updates twice.
+    from tg_bot.warmup import process_local_settings
+
+    missing = process_local_settings()
+    if server.cfg.workers > 1 and missing:
+        raise RuntimeError(f'{server.cfg.workers} workers share no state without {", ".join(missing)}. '
+                           f'Set them or run a single worker (WEB_CONCURRENCY=1).')
+
+
+def when_ready(server):
+    # Runs in the master once the app is loaded, before the workers are forked.
+    from tg_bot.commands import command_registry
+    from tg_bot.sender import sender
+    from tg_bot.warmup import rss_bytes, startup
+
+    command_registry.sync()
+    # The sync connected the master to the Bot API; the connection must not be inherited by the workers.
+    sender.session.close()
+    startup['master_ready_ms'] = round((time.monotonic() - CONFIG_LOADED) * 1000, 1)
+    server.log.info('App loaded in %.1f ms, master RSS %.1f MB', startup['master_ready_ms'],
+                    rss_bytes() / 1024 / 1024)
+
+
+def post_fork(server, worker):
+    from tg_bot import app
+    from tg_bot.scheduler import weather_alerts
+    from tg_bot.warmup import private_bytes, reset_connections, rss_bytes, startup, warm_up
+
+    start = time.monotonic()
+    reset_connections(app)
+    startup['warm_up'] = warm_up(app)
+    startup['worker_ready_ms'] = round((time.monotonic() - start) * 1000, 1)
+    # Every worker runs the scheduler; each tick is claimed in the database, so it runs in one of them only.
+    weather_alerts.start()
+    server.log.info('Worker %s warmed up in %.1f ms (%s), RSS %.1f MB, private %.1f MB', worker.pid,
+                    startup['worker_ready_ms'],
+                    ', '.join(f'{name} {value}' for name, value in startup['warm_up'].items()),
+                    rss_bytes() / 1024 / 1024, (private_bytes() or 0) / 1024 / 1024)
@@ -0,0 +1,11 @@
+from tg_bot.commands import command_registry
+from tg_bot.polling import UpdatePoller
+from tg_bot.scheduler import weather_alerts
+from tg_bot.sender import sender
+
+# getUpdates is refused while a webhook is set, so the webhook is removed before polling.
+sender.call('deleteWebhook', {})
+command_registry.sync()
+weather_alerts.start()
+
+UpdatePoller().run()
@@ -1,4 +1,9 @@
 from tg_bot import app
+from tg_bot.commands import command_registry
+from tg_bot.scheduler import weather_alerts
+
+command_registry.sync()
+weather_alerts.start()
 
 app.run(port=4242,
         debug=True)
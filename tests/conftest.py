@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# The package reads its configuration at import time, so the environment is set before any test imports tg_bot.
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('BOT_TOKEN', 'TEST')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def database():
+    # Creates the tables in the in-memory database for one test and drops them afterwards.
+    from tg_bot import app, db
+    with app.app_context():
+        db.create_all(bind_key=None)
+        yield db
+        db.session.remove()
+        db.drop_all(bind_key=None)
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from tg_bot import callback_codec
+from tg_bot.cache import MemoryCacheBackend
+
+
+@pytest.fixture(autouse=True)
+def empty_token_store(monkeypatch):
+    monkeypatch.setattr(callback_codec, 'token_store', MemoryCacheBackend(60, 100))
+
+
+@pytest.mark.parametrize('callback_type, data', [
+    ('/create_list', {'list_name': 'groceries'}),
+    ('/edit_list', {'old_list_name': 'old', 'new_list_name': 'new'}),
+    ('/add_item', {'list_name': 'groceries', 'item': 'milk'}),
+    ('/items_page', {'l': 42, 'a': 1234567}),
+    ('/items_page', {'l': 42, 'b': 7}),
+    ('/contacts_page', {'s': 0, 'a': 35}),
+    ('/weather_city', {'lat': 50.45466, 'lon': 30.5238}),
+])
+def test_round_trip(callback_type, data):
+    encoded = callback_codec.encode(callback_type, **data)
+    assert len(encoded.encode()) <= callback_codec.CALLBACK_DATA_LIMIT
+    assert callback_codec.decode(encoded) == dict(data, type=callback_type)
+
+
+def test_negative_coordinates():
+    encoded = callback_codec.encode('/weather_city', lat=-33.86785, lon=-151.20732)
+    assert callback_codec.decode(encoded) == {'type': '/weather_city', 'lat': -33.86785, 'lon': -151.20732}
+
+
+def test_coordinates_are_rounded_to_the_scale():
+    decoded = callback_codec.decode(callback_codec.encode('/weather_city', lat=1.234567891, lon=0))
+    assert decoded == {'type': '/weather_city', 'lat': 1.23457, 'lon': 0.0}
+
+
+@pytest.mark.parametrize('name', ['a:b', '100%', '%3A', 'a::b%%', ':', 'list with spaces', 'список'])
+def test_strings_are_escaped(name):
+    encoded = callback_codec.encode('/edit_list', old_list_name=name, new_list_name='x:y')
+    assert callback_codec.decode(encoded) == {'type': '/edit_list', 'old_list_name': name, 'new_list_name': 'x:y'}
+
+
+def test_missing_fields_are_left_out():
+    assert callback_codec.encode('/items_page', l=1) == 'p:1'
+    assert callback_codec.decode(callback_codec.encode('/items_page', l=1, b=5)) == {'type': '/items_page', 'l': 1,
+                                                                                     'b': 5}
+
+
+def test_token_over_the_limit():
+    data = {'list_name': 'l' * 40, 'item': 'i' * 40}
+    encoded = callback_codec.encode('/add_item', **data)
+    assert encoded.startswith(callback_codec.TOKEN_CODE)
+    assert len(encoded.encode()) <= callback_codec.CALLBACK_DATA_LIMIT
+    assert callback_codec.decode(encoded) == dict(data, type='/add_item')
+
+
+def test_limit_counts_bytes_not_characters():
+    # 32 two-byte characters are 64 bytes, over the limit once the code and separator are added.
+    assert callback_codec.encode('/show_items', list_name='ж' * 32).startswith(callback_codec.TOKEN_CODE)
+    assert not callback_codec.encode('/show_items', list_name='ж' * 31).startswith(callback_codec.TOKEN_CODE)
+
+
+def test_expired_token():
+    encoded = callback_codec.encode('/add_item', list_name='l' * 40, item='i' * 40)
+    callback_codec.token_store.delete(encoded[len(callback_codec.TOKEN_CODE):])
+    assert callback_codec.decode(encoded) is None
+    assert callback_codec.decode(callback_codec.TOKEN_CODE + 'unknown') is None
+
+
+def test_legacy_json():
+    data = {'type': '/show_items', 'list_name': 'groceries'}
+    assert callback_codec.decode(json.dumps(data)) == data
+    assert callback_codec.decode('{broken') == {}
+    assert callback_codec.decode('[1, 2]') == {}
+
+
+@pytest.mark.parametrize('callback_data', [None, '', 'z:1', 'p:not-a-number'])
+def test_unreadable_data_has_no_type(callback_data):
+    assert callback_codec.decode(callback_data) == {}
@@ -0,0 +1,76 @@
+import pytest
+
+from tg_bot.contact_files import detect_format, parse, parse_csv, parse_vcard, serialize
+
+
+def lines(text):
+    return text.splitlines(keepends=True)
+
+
+def test_csv_without_header():
+    rows = parse_csv(lines('Olena,Kovalenko,+380501234567\r\n\r\nOleh, Shevchenko ,0671112233\n'))
+    assert list(rows) == [('Olena', 'Kovalenko', '+380501234567'), ('Oleh', 'Shevchenko', '0671112233')]
+
+
+def test_csv_with_header_in_any_order():
+    text = 'Phone,Surname,First Name,Email\n+380501234567,Kovalenko,Olena,olena@example.com\n'
+    assert list(parse_csv(lines(text))) == [('Olena', 'Kovalenko', '+380501234567')]
+
+
+def test_csv_header_with_some_known_names():
+    text = 'Name,Surname,Phone\nOlena,Kovalenko,+380501234567\n'
+    assert list(parse_csv(lines(text))) == [('Olena', 'Kovalenko', '+380501234567')]
+    # A column missing from the header is read as empty.
+    assert list(parse_csv(lines('Name,Phone\nOlena,+380501234567\n'))) == [('Olena', '', '+380501234567')]
+
+
+def test_csv_google_header():
+    text = ('Name,Given Name,Additional Name,Family Name,Phone 1 - Type,Phone 1 - Value\n'
+            'Olena Kovalenko,Olena,,Kovalenko,Mobile,+380501234567\n')
+    assert list(parse_csv(lines(text))) == [('Olena', 'Kovalenko', '+380501234567')]
+
+
+def test_csv_header_with_dashes():
+    text = 'first-name,last-name,mobile-phone\nOlena,Kovalenko,+380501234567\n'
+    assert list(parse_csv(lines(text))) == [('Olena', 'Kovalenko', '+380501234567')]
+
+
+def test_csv_short_rows_and_quoted_cells():
+    text = 'Olena\n"Kovalenko, Olena",,"+38 050"\n'
+    assert list(parse_csv(lines(text))) == [('Olena', '', ''), ('Kovalenko, Olena', '', '+38 050')]
+
+
+def test_vcard():
+    text = ('BEGIN:VCARD\r\nVERSION:3.0\r\nN:Kovalenko;Olena;;;\r\nFN:Olena Kovalenko\r\n'
+            'item1.TEL;TYPE=CELL:+380501234567\r\nTEL;TYPE=HOME:+380441234567\r\nEND:VCARD\r\n'
+            'BEGIN:VCARD\r\nVERSION:4.0\r\nFN:Oleh Shevchenko\r\nTEL;VALUE=uri:tel:+380671112233\r\nEND:VCARD\r\n')
+    assert list(parse_vcard(lines(text))) == [('Olena', 'Kovalenko', '+380501234567'),
+                                              ('Oleh', 'Shevchenko', '+380671112233')]
+
+
+def test_vcard_folded_and_escaped_lines():
+    text = 'begin:vcard\nN:Kovalenko\\; Jr.;Ole\n na;;;\nTEL:+380\n\t501234567\nend:vcard\n'
+    assert list(parse_vcard(lines(text))) == [('Olena', 'Kovalenko; Jr.', '+380501234567')]
+
+
+def test_vcard_properties_outside_a_card_are_ignored():
+    text = 'N:Stray;Name\nBEGIN:VCARD\nFN:Olena\nEND:VCARD\nEND:VCARD\n'
+    assert list(parse_vcard(lines(text))) == [('Olena', '', '')]
+
+
+@pytest.mark.parametrize('contact_format', ['csv', 'vcard'])
+def test_round_trip(contact_format):
+    rows = [('Olena', 'Kovalenko', '+380501234567'), ('Oleh, Jr.', 'Shev;chenko', '0671112233')]
+    text = ''.join(serialize(rows, contact_format))
+    assert list(parse(lines(text), contact_format)) == rows
+
+
+@pytest.mark.parametrize('file_name, mime_type, contact_format', [
+    ('contacts.vcf', None, 'vcard'),
+    ('CONTACTS.VCARD', None, 'vcard'),
+    (None, 'text/x-vcard', 'vcard'),
+    ('contacts.csv', 'text/csv', 'csv'),
+    (None, None, 'csv'),
+])
+def test_detect_format(file_name, mime_type, contact_format):
+    assert detect_format(file_name, mime_type) == contact_format
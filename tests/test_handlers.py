@@ -0,0 +1,25 @@
+from tg_bot.handlers import MESSAGE_LIMIT, split_message
+
+
+def test_short_text_is_one_part():
+    assert split_message('') == ['']
+    assert split_message('a' * MESSAGE_LIMIT) == ['a' * MESSAGE_LIMIT]
+
+
+def test_split_at_line_breaks():
+    assert split_message('aaaa\nbbbb\ncc', limit=10) == ['aaaa\nbbbb', 'cc']
+    assert split_message('aaaa\nbbbb\ncc', limit=9) == ['aaaa\nbbbb', 'cc']
+    assert split_message('aaaa\nbbbb\ncc', limit=8) == ['aaaa', 'bbbb\ncc']
+
+
+def test_split_long_lines_at_the_limit():
+    assert split_message('a' * 25, limit=10) == ['a' * 10, 'a' * 10, 'a' * 5]
+    assert split_message('\n' + 'a' * 12, limit=10) == ['\n' + 'a' * 9, 'aaa']
+
+
+def test_every_part_fits_and_no_text_is_lost():
+    text = '\n'.join(f'{i}. item number {i}' for i in range(1000))
+    parts = split_message(text)
+    assert len(parts) > 1
+    assert all(len(part) <= MESSAGE_LIMIT for part in parts)
+    assert '\n'.join(parts) == text
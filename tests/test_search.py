@@ -0,0 +1,118 @@
+import pytest
+
+from tg_bot.search import ContactIndex, ContactSearch, edit_distance
+
+CONTACTS = [
+    (1, 'Olena', 'Kovalenko', '+38 050 123 45 67'),
+    (2, 'Oleh', 'Shevchenko', '+380671112233'),
+    (3, 'Andrii', 'Kovalchuk', '0931234567'),
+    (4, 'Iryna', 'Bondarenko', '+380501234567'),
+]
+
+
+def ids(rows):
+    return [row[0] for row in rows]
+
+
+@pytest.mark.parametrize('a, b, distance', [
+    ('', '', 0),
+    ('olena', 'olena', 0),
+    ('olena', 'olna', 1),
+    ('olena', 'oleny', 1),
+    ('olena', 'oelna', 1),
+    ('kitten', 'sitting', 3),
+    ('', 'abc', 3),
+])
+def test_edit_distance(a, b, distance):
+    assert edit_distance(a, b, 5) == distance
+    assert edit_distance(b, a, 5) == distance
+
+
+def test_edit_distance_stops_over_the_limit():
+    assert edit_distance('kitten', 'sitting', 1) == 2
+    assert edit_distance('a', 'abcdef', 2) == 3
+
+
+def test_prefix_match():
+    index = ContactIndex(CONTACTS)
+    # Matches with the same score are ordered by name.
+    assert ids(index.search('ole')) == [2, 1]
+    assert ids(index.search('koval')) == [3, 1]
+    assert ids(index.search('OLENA')) == [1]
+
+
+def test_every_word_must_match():
+    index = ContactIndex(CONTACTS)
+    assert ids(index.search('ole kov')) == [1]
+    assert index.search('ole bond') == []
+    assert index.search('') == []
+
+
+def test_phone_number_match():
+    index = ContactIndex(CONTACTS)
+    assert ids(index.search('+38050')) == [4, 1]
+    # A number written in groups is found by its local part too.
+    assert ids(index.search('0501234567')) == [1]
+    assert ids(index.search('093')) == [3]
+
+
+def test_fuzzy_match_ranks_below_prefix_match():
+    index = ContactIndex(CONTACTS)
+    assert ids(index.search('shevcenko')) == [2]
+    assert ids(index.search('iryan')) == [4]
+    assert ids(index.search('bon')) == [4]
+    assert index.search('xyz') == []
+
+
+def test_limit():
+    index = ContactIndex(CONTACTS)
+    assert ids(index.search('o', limit=1)) == [2]
+
+
+def test_add_and_remove():
+    index = ContactIndex(CONTACTS[:2])
+    index.add(*CONTACTS[2])
+    assert ids(index.search('andrii')) == [3]
+    assert index.terms == sorted(index.terms)
+    index.remove(1)
+    index.remove(1)
+    assert ids(index.search('ole')) == [2]
+    assert ids(index.search('koval')) == [3]
+    assert all(contact_id != 1 for _, contact_id in index.terms)
+    assert all(1 not in contact_ids for contact_ids in index.trigrams.values())
+
+
+def test_build_matches_adding_one_by_one():
+    built = ContactIndex(CONTACTS)
+    added = ContactIndex()
+    for row in CONTACTS:
+        added.add(*row)
+    assert built.terms == added.terms
+    assert built.trigrams == added.trigrams
+
+
+def test_search_rebuilds_on_a_new_version():
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return CONTACTS[:len(loads) + 1]
+
+    search = ContactSearch()
+    assert ids(search.search(7, 0, 'andrii', loader)) == []
+    assert ids(search.search(7, 0, 'andrii', loader)) == []
+    assert len(loads) == 1
+    # Another process changed the contacts, so the version in the database has moved on.
+    assert ids(search.search(7, 1, 'andrii', loader)) == [3]
+    assert len(loads) == 2
+
+
+def test_search_keeps_an_index_updated_in_place():
+    search = ContactSearch()
+    search.search(7, 0, 'x', lambda: CONTACTS)
+    search.add(7, 5, 'Taras', 'Melnyk', '+380441234567')
+    search.remove(7, 1)
+    assert ids(search.search(7, 2, 'taras', lambda: pytest.fail('index rebuilt'))) == [5]
+    assert ids(search.search(7, 2, 'olena', lambda: pytest.fail('index rebuilt'))) == []
+    search.invalidate(7)
+    assert ids(search.search(7, 2, 'olena', lambda: CONTACTS)) == [1]
@@ -0,0 +1,67 @@
+import pytest
+
+from tg_bot.sender import TelegramSender, TokenBucket, _ChatQueue
+
+
+def test_burst_up_to_capacity():
+    bucket = TokenBucket(rate=2, capacity=3)
+    bucket.updated = 0.0
+    for _ in range(3):
+        assert bucket.delay(0.0) == 0.0
+        bucket.take(0.0)
+    assert bucket.delay(0.0) == pytest.approx(0.5)
+
+
+def test_refill_at_the_rate():
+    bucket = TokenBucket(rate=2, capacity=3)
+    bucket.updated = 0.0
+    for _ in range(3):
+        bucket.take(0.0)
+    assert bucket.delay(0.25) == pytest.approx(0.25)
+    assert bucket.delay(0.5) == 0.0
+    bucket.take(0.5)
+    assert bucket.delay(0.5) == pytest.approx(0.5)
+
+
+def test_refill_stops_at_capacity():
+    bucket = TokenBucket(rate=2, capacity=3)
+    bucket.updated = 0.0
+    bucket.take(0.0)
+    assert not bucket.is_full(0.0)
+    assert bucket.is_full(100.0)
+    for _ in range(3):
+        bucket.take(100.0)
+    assert bucket.delay(100.0) == pytest.approx(0.5)
+
+
+def test_rate_zero_allows_every_event():
+    bucket = TokenBucket(rate=0, capacity=1)
+    for _ in range(10):
+        assert bucket.delay(0.0) == 0.0
+        bucket.take(0.0)
+    assert bucket.is_full(0.0)
+
+
+def test_inline_calls_take_tokens():
+    sender = TelegramSender('http://127.0.0.1:9/bot', 'TEST', global_rate=30, chat_rate=1, chat_burst=2)
+    assert sender.take_inline(1)
+    assert sender.take_inline(1)
+    assert not sender.take_inline(1)
+    assert sender.take_inline(2)
+    sender.chats[2].bucket.updated -= 1
+    assert sender.take_inline(2)
+
+
+def test_inline_calls_wait_for_queued_calls():
+    sender = TelegramSender('http://127.0.0.1:9/bot', 'TEST', global_rate=0, chat_rate=0)
+    sender.chats[1] = _ChatQueue(0, 1)
+    sender.chats[1].jobs.append(object())
+    assert not sender.take_inline(1)
+    assert sender.take_inline(2)
+
+
+def test_inline_calls_forget_idle_chats():
+    sender = TelegramSender('http://127.0.0.1:9/bot', 'TEST', global_rate=0, chat_rate=0)
+    for chat_id in range(100):
+        assert sender.take_inline(chat_id)
+    assert list(sender.chats) == [99]
@@ -0,0 +1,56 @@
+import pytest
+
+from tg_bot.models import ContactBook, Item, ShopList, User
+from tg_bot.services import ContactBookService, Page, ShopWizardException, ShopWizardService, rows_page
+
+
+def test_first_page():
+    assert rows_page([1, 2, 3], size=2) == Page([1, 2], False, True)
+    assert rows_page([1, 2], size=2) == Page([1, 2], False, False)
+    assert rows_page([], size=2) == Page([], False, False)
+
+
+def test_page_after():
+    assert rows_page([3, 4, 5], after_id=2, size=2) == Page([3, 4], True, True)
+    assert rows_page([5], after_id=4, size=2) == Page([5], True, False)
+
+
+def test_page_before():
+    # Rows before an ID are fetched in descending order and returned in ascending order.
+    assert rows_page([4, 3, 2], before_id=5, size=2) == Page([3, 4], True, True)
+    assert rows_page([2, 1], before_id=3, size=2) == Page([1, 2], False, True)
+
+
+def test_import_skips_phone_numbers_without_digits(database):
+    user = User(id=1)
+    database.session.add(user)
+    database.session.commit()
+    rows = [('Name', 'Surname', 'Phone'), ('Olena', 'Kovalenko', '+380501234567'), ('Oleh', 'Shevchenko', 'n/a')]
+    assert ContactBookService.import_contacts(user, rows) == (1, 0, 2)
+    assert database.session.query(ContactBook.first_name).all() == [('Olena',)]
+
+
+def test_remove_items_with_duplicates_and_missing_names(database):
+    user = User(id=1)
+    database.session.add(user)
+    database.session.commit()
+    ShopWizardService.create_shop_list(user, 'g')
+    ShopWizardService.add_items_to_list(user, 'g', ['milk', 'milk', 'eggs', 'bread'])
+    removed, not_found = ShopWizardService.remove_items_from_list(user, 'g', ['milk', 'milk', 'milk', 'tea', 'eggs'])
+    assert removed == ['milk', 'milk', 'eggs']
+    assert not_found == ['milk', 'tea']
+    shop_list = ShopList.query.filter_by(user_id=1, list_name='g').one()
+    assert [name for _, name in database.session.query(Item.id, Item.name).filter(Item.list_id == shop_list.id)] \
+        == ['bread']
+    assert shop_list.item_count == 1
+
+
+def test_remove_items_none_found(database):
+    user = User(id=1)
+    database.session.add(user)
+    database.session.commit()
+    ShopWizardService.create_shop_list(user, 'g')
+    ShopWizardService.add_items_to_list(user, 'g', ['milk'])
+    with pytest.raises(ShopWizardException):
+        ShopWizardService.remove_items_from_list(user, 'g', ['tea', 'tea'])
+    assert ShopList.query.filter_by(user_id=1, list_name='g').one().item_count == 1
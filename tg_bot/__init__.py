@@ -6,15 +6,21 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+from .routing import RoutingSession, replica_binds, router
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_BINDS'] = replica_binds()
 
 
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+router.init_app(db, app.config['SQLALCHEMY_BINDS'])
+# Batch mode lets the migrations add constraints on SQLite, which cannot alter them in place.
+migrate = Migrate(app, db, render_as_batch=True)
 
 
 from .views import *
 from .models import *
+from .cli import *
 
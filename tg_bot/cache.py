@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class TTLCache:
+    # This is a class that caches values for a fixed time to live and evicts the least recently used entries once the
+    # size limit is reached. Concurrent misses for the same key are coalesced, so only one of them calls the loader
+    # and the others wait for its result.
+    def __init__(self, ttl, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        # Returns the cached value for the key, or the default if there is no fresh value.
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        # Caches the value for the key and evicts the least recently used entries above the size limit.
+        with self._lock:
+            self._set(key, value)
+
+    def delete(self, key):
+        # Removes the cached value for the key.
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        # Removes every cached value.
+        with self._lock:
+            self.entries.clear()
+
+    def get_or_load(self, key, loader, timeout=None):
+        # Returns the cached value for the key. On a miss the value is loaded with loader() and cached; a miss which
+        # finds a load of the same key in progress waits for it instead of loading again, for at most timeout seconds
+        # if given, and raises concurrent.futures.TimeoutError when the load takes longer.
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            return future.result(timeout)
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._set(key, value)
+            del self.inflight[key]
+        future.set_result(value)
+        return value
+
+    def stats(self):
+        # Returns the size of the cache, the hit and miss counters and the hit ratio.
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class MemoryCacheBackend:
+    # This is a class that keeps cached values in process memory. It is the default backend of the shared caches.
+    def __init__(self, ttl, max_size=1024):
+        self.cache = TTLCache(ttl, max_size)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.cache.delete(key)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class RedisCacheBackend:
+    # This is a class that keeps cached values as JSON in Redis, so every worker process shares them. It needs the
+    # optional redis package.
+    def __init__(self, url, ttl, prefix='tg_bot:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), px=int(self.ttl * 1000))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*(self.prefix + key for key in keys))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def create_cache_backend(url, ttl, max_size=1024):
+    # Returns the Redis backend for a redis:// URL and the in-process backend otherwise.
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCacheBackend(url, ttl)
+    return MemoryCacheBackend(ttl, max_size)
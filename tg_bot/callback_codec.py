@@ -0,0 +1,115 @@
+import json
+import os
+import secrets
+import string
+from urllib.parse import unquote
+
+from . import metrics
+from .cache import create_cache_backend
+
+# Telegram rejects inline buttons whose callback_data is longer than this many bytes.
+CALLBACK_DATA_LIMIT = 64
+# Callback data over the limit is kept in a token store for this many seconds, so older buttons stop working after it.
+CALLBACK_TOKEN_TTL = int(os.getenv('CALLBACK_TOKEN_TTL', 7 * 24 * 3600))
+CALLBACK_TOKEN_MAX_SIZE = int(os.getenv('CALLBACK_TOKEN_MAX_SIZE', 100000))
+# Set to a redis:// URL to share the tokens between worker processes. They are kept in process memory otherwise.
+CALLBACK_TOKEN_URL = os.getenv('CALLBACK_TOKEN_URL')
+
+# Fixed precision of the packed coordinates, 5 decimal places are about one metre.
+COORDINATE_SCALE = 10 ** 5
+
+SEPARATOR = ':'
+TOKEN_CODE = '~'
+DIGITS = string.digits + string.ascii_lowercase
+
+# The short code and the fields of every callback type. Fields are packed in this order as a string ('s'), an integer
+# ('i') or a coordinate ('c'); missing fields are left empty.
+CALLBACK_TYPES = {
+    '/create_list': ('c', (('list_name', 's'),)),
+    '/remove_list': ('r', (('list_name', 's'),)),
+    '/edit_list': ('e', (('old_list_name', 's'), ('new_list_name', 's'))),
+    '/add_item': ('a', (('list_name', 's'), ('item', 's'))),
+    '/show_items': ('s', (('list_name', 's'),)),
+    '/items_page': ('p', (('l', 'i'), ('a', 'i'), ('b', 'i'))),
+    '/contacts_page': ('k', (('s', 'i'), ('a', 'i'), ('b', 'i'))),
+    '/weather_city': ('w', (('lat', 'c'), ('lon', 'c'))),
+}
+CALLBACK_CODES = {code: (callback_type, fields) for callback_type, (code, fields) in CALLBACK_TYPES.items()}
+
+token_store = create_cache_backend(CALLBACK_TOKEN_URL, CALLBACK_TOKEN_TTL, CALLBACK_TOKEN_MAX_SIZE)
+
+
+def encode(callback_type, **data):
+    # Returns the callback_data of a button of the callback type, e.g. 'w:34kgx:-sqbz' for a '/weather_city' button.
+    # Data which does not fit into the Telegram limit is kept in the token store and replaced by a token.
+    code, fields = CALLBACK_TYPES[callback_type]
+    values = [_pack(data.get(name), kind) for name, kind in fields]
+    while values and values[-1] == '':
+        values.pop()
+    packed = SEPARATOR.join([code, *values])
+    if len(packed.encode()) <= CALLBACK_DATA_LIMIT:
+        return packed
+    token = secrets.token_urlsafe(12)
+    token_store.set(token, dict(data, type=callback_type))
+    metrics.callback_tokens.inc('issued')
+    return TOKEN_CODE + token
+
+
+def decode(callback_data):
+    # Returns the data of a callback with its 'type' key, or None if the callback refers to an expired token. Data
+    # which cannot be read has no type. Buttons sent as JSON before the codec was introduced are still accepted.
+    callback_data = callback_data or ''
+    if callback_data.startswith(TOKEN_CODE):
+        data = token_store.get(callback_data[len(TOKEN_CODE):])
+        if data is None:
+            metrics.callback_tokens.inc('expired')
+            return None
+        return dict(data)
+    if callback_data.startswith('{'):
+        try:
+            data = json.loads(callback_data)
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+    code, *values = callback_data.split(SEPARATOR)
+    if code not in CALLBACK_CODES:
+        return {}
+    callback_type, fields = CALLBACK_CODES[code]
+    data = {'type': callback_type}
+    try:
+        for (name, kind), value in zip(fields, values):
+            if value:
+                data[name] = _unpack(value, kind)
+    except ValueError:
+        return {}
+    return data
+
+
+def _pack(value, kind):
+    if value is None:
+        return ''
+    if kind == 'i':
+        return _to_base36(int(value))
+    if kind == 'c':
+        return _to_base36(round(float(value) * COORDINATE_SCALE))
+    # Strings are percent-encoded only where they would break the format.
+    return str(value).replace('%', '%25').replace(SEPARATOR, '%3A')
+
+
+def _unpack(value, kind):
+    if kind == 'i':
+        return int(value, 36)
+    if kind == 'c':
+        return int(value, 36) / COORDINATE_SCALE
+    return unquote(value)
+
+
+def _to_base36(number):
+    sign = '-' if number < 0 else ''
+    number = abs(number)
+    digits = ''
+    while True:
+        number, digit = divmod(number, 36)
+        digits = DIGITS[digit] + digits
+        if not number:
+            return sign + digits
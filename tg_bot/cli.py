@@ -0,0 +1,58 @@
+import click
+from sqlalchemy import delete, func, select, update
+
+from tg_bot import app, db
+from .models import ContactBook, Item, ShopList, User
+
+
+def recount():
+    # Recomputes the contact count of every user and the item count of every shop list from the rows they count, and
+    # returns the numbers of corrected users and lists. Only counters which drifted are written.
+    contacts = select(func.count(ContactBook.id)).where(ContactBook.user_id == User.id).scalar_subquery()
+    items = select(func.count(Item.id)).where(Item.list_id == ShopList.id).scalar_subquery()
+    users = db.session.execute(db.update(User).where(User.contact_count != contacts)
+                               .values(contact_count=contacts).execution_options(synchronize_session=False))
+    lists = db.session.execute(db.update(ShopList).where(ShopList.item_count != items)
+                               .values(item_count=items).execution_options(synchronize_session=False))
+    db.session.commit()
+    return users.rowcount, lists.rowcount
+
+
+@app.cli.command('recount')
+def recount_command():
+    """Recompute the contact counts of the users and the item counts of the shop lists."""
+    users, lists = recount()
+    click.echo(f'Corrected the contact count of {users} user(s) and the item count of {lists} shop list(s).')
+
+
+def dedupe():
+    # Merges the duplicate shop lists of every user into the oldest list of the same name, moving their items to it,
+    # and deletes the duplicate contacts of every user, keeping the most recently added one. Only the columns which
+    # existed before the unique constraints were added are used, so it runs on a database which is not migrated yet.
+    # It returns the numbers of merged lists and deleted contacts.
+    lists = ShopList.__table__
+    items = Item.__table__
+    contacts = ContactBook.__table__
+    merged = 0
+    groups = db.session.execute(select(lists.c.user_id, lists.c.list_name).group_by(lists.c.user_id, lists.c.list_name)
+                                .having(func.count() > 1)).all()
+    for user_id, list_name in groups:
+        keep, *duplicates = db.session.execute(select(lists.c.id).where(lists.c.user_id == user_id,
+                                                                         lists.c.list_name == list_name)
+                                               .order_by(lists.c.id)).scalars()
+        db.session.execute(update(items).where(items.c.list_id.in_(duplicates)).values(list_id=keep))
+        db.session.execute(delete(lists).where(lists.c.id.in_(duplicates)))
+        merged += len(duplicates)
+    # The kept IDs are read through a derived table, as MySQL cannot delete from a table it selects from directly.
+    keep = select(func.max(contacts.c.id).label('id')) \
+        .group_by(contacts.c.user_id, contacts.c.first_name, contacts.c.last_name).subquery()
+    removed = db.session.execute(delete(contacts).where(contacts.c.id.not_in(select(keep.c.id)))).rowcount
+    db.session.commit()
+    return merged, removed
+
+
+@app.cli.command('dedupe')
+def dedupe_command():
+    """Merge duplicate shop lists and delete duplicate contacts before the unique constraints are migrated."""
+    merged, removed = dedupe()
+    click.echo(f'Merged {merged} duplicate shop list(s) and deleted {removed} duplicate contact(s).')
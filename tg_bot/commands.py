@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+
+import requests
+
+from .sender import sender
+
+COMMANDS_STATE_FILE = os.getenv('COMMANDS_STATE_FILE', '.bot_commands.json')
+
+
+class CommandRegistry:
+    # This is a class that keeps the command menus of the bot. Every command set is synced to Telegram with
+    # setMyCommands only when its fingerprint differs from the last synced one, which is kept in a local state file so
+    # restarts skip the sync too.
+    def __init__(self, state_file=COMMANDS_STATE_FILE):
+        self.state_file = state_file
+        self.command_sets = {}
+
+    def register(self, commands, scope=None, language_code=None):
+        # Registers a command set for the given scope (e.g. {'type': 'all_private_chats'}) and language code. Both are
+        # optional, the default set is used for every user without a more specific one.
+        self.command_sets[self.key(scope, language_code)] = (commands, scope, language_code)
+
+    @staticmethod
+    def key(scope=None, language_code=None):
+        # Returns the key the command set of the given scope and language code is stored under.
+        return f'{json.dumps(scope, sort_keys=True)}|{language_code or ""}'
+
+    @staticmethod
+    def fingerprint(commands, scope=None, language_code=None):
+        # Returns a hash of the command set, which changes whenever a command or its description changes.
+        payload = json.dumps([commands, scope, language_code], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def sync(self, force=False):
+        # Sends setMyCommands for every command set that changed since the last sync and returns the number of sets
+        # that were sent.
+        state = self._load_state()
+        synced = 0
+        for key, (commands, scope, language_code) in self.command_sets.items():
+            fingerprint = self.fingerprint(commands, scope, language_code)
+            if not force and state.get(key) == fingerprint:
+                continue
+            data = {
+                'commands': commands
+            }
+            if scope:
+                data['scope'] = scope
+            if language_code:
+                data['language_code'] = language_code
+            try:
+                res = sender.call('setMyCommands', data)
+            except requests.RequestException:
+                continue
+            if res.status_code == 200:
+                state[key] = fingerprint
+                synced += 1
+        self._save_state(state)
+        return synced
+
+    def _load_state(self):
+        # Reads the fingerprints of the last synced command sets from the state file.
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        # Writes the fingerprints of the synced command sets to the state file.
+        try:
+            with open(self.state_file, 'w') as f:
+                json.dump(state, f)
+        except OSError:
+            pass
+
+
+command_registry = CommandRegistry()
+command_registry.register([
+    {'command': '/commands', 'description': 'Get to know the available commands'},
+    {'command': '/weather', 'description': 'Get the weather for a city'},
+    {'command': '/lists', 'description': 'Get your shop lists and their sizes'},
+    {'command': '/status', 'description': 'Get the amount of contacts'},
+    {'command': '/list', 'description': 'Get the list of contacts'},
+])
@@ -0,0 +1,134 @@
+import csv
+import io
+import re
+
+# Formats of contact files: the file extension and the MIME type of each, used for both import and export.
+FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'vcard': ('vcf', 'text/vcard'),
+}
+
+CSV_HEADER = ('first_name', 'last_name', 'phone_number')
+
+# Header names recognized in imported CSV files for every column, after lowercasing and replacing spaces and dashes with
+# underscores, in order of preference. A first row with any recognized name is a header; files without one are read as
+# first name, last name and phone number columns.
+CSV_COLUMN_NAMES = (
+    ('first_name', 'first', 'given_name', 'firstname', 'name'),
+    ('last_name', 'last', 'family_name', 'surname', 'lastname'),
+    ('phone_number', 'phone', 'mobile', 'mobile_phone', 'tel', 'telephone', 'phone_1_value'),
+)
+
+WRITE_BATCH_SIZE = 500
+
+
+def detect_format(file_name=None, mime_type=None):
+    # Returns the format of a contact file from its name or MIME type. Files which are not recognized as vCard are
+    # read as CSV.
+    if (file_name or '').lower().endswith(('.vcf', '.vcard')) or 'vcard' in (mime_type or '').lower():
+        return 'vcard'
+    return 'csv'
+
+
+def parse(lines, contact_format):
+    # Returns an iterator of (first name, last name, phone number) rows read from the text lines of a contact file.
+    # The lines are consumed one at a time, so the file never has to be held in memory.
+    return parse_vcard(lines) if contact_format == 'vcard' else parse_csv(lines)
+
+
+def serialize(rows, contact_format):
+    # Returns an iterator of text chunks of a contact file holding the (first name, last name, phone number) rows.
+    return serialize_vcard(rows) if contact_format == 'vcard' else serialize_csv(rows)
+
+
+def parse_csv(lines):
+    columns = (0, 1, 2)
+    for i, row in enumerate(csv.reader(lines)):
+        if not row:
+            continue
+        if i == 0:
+            header = [re.sub(r'[\s-]+', '_', cell.strip().lower()) for cell in row]
+            found = [next((header.index(name) for name in names if name in header), None) for names in CSV_COLUMN_NAMES]
+            if found != [None, None, None]:
+                # Columns missing from the header are read as empty, so their rows are reported as invalid.
+                columns = found
+                continue
+        yield tuple(row[j].strip() if j is not None and j < len(row) else '' for j in columns)
+
+
+def serialize_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % WRITE_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _unfold(lines):
+    # Joins the folded lines of a vCard, i.e. lines continued on the next line starting with a space or a tab.
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) in 'nN' else match.group(1), value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace(';', '\\;').replace('\n', '\\n')
+
+
+def parse_vcard(lines):
+    card = None
+    for line in _unfold(lines):
+        name, _, value = line.partition(':')
+        # Drops the group ('item1.TEL') and the parameters ('TEL;TYPE=CELL') of the property name.
+        name = name.split(';', 1)[0].rsplit('.', 1)[-1].strip().upper()
+        if name == 'BEGIN' and value.strip().upper() == 'VCARD':
+            card = {}
+        elif name == 'END' and card is not None:
+            yield _card_row(card)
+            card = None
+        elif card is not None and name in ('N', 'FN', 'TEL') and name not in card:
+            card[name] = value.strip()
+
+
+def _card_row(card):
+    # Returns the (first name, last name, phone number) row of a vCard. The structured N property is preferred, the
+    # formatted FN name is split at its first space otherwise.
+    family, given = '', ''
+    if card.get('N'):
+        parts = [_unescape(part).strip() for part in re.split(r'(?<!\\);', card['N'])]
+        family, given = parts[0], parts[1] if len(parts) > 1 else ''
+    if not (family and given) and card.get('FN'):
+        given, _, family = _unescape(card['FN']).strip().partition(' ')
+    phone = card.get('TEL', '')
+    if phone.lower().startswith('tel:'):
+        phone = phone[4:]
+    return given.strip(), family.strip(), phone
+
+
+def serialize_vcard(rows):
+    chunk = []
+    for i, (first_name, last_name, phone_number) in enumerate(rows, 1):
+        chunk.append(f'BEGIN:VCARD\r\nVERSION:3.0\r\nN:{_escape(last_name)};{_escape(first_name)};;;\r\n'
+                     f'FN:{_escape(f"{first_name} {last_name}")}\r\nTEL;TYPE=CELL:{_escape(phone_number)}\r\n'
+                     f'END:VCARD\r\n')
+        if i % WRITE_BATCH_SIZE == 0:
+            yield ''.join(chunk)
+            chunk = []
+    yield ''.join(chunk)
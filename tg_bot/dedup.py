@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from tg_bot import db
+from .models import ProcessedUpdate
+
+DEDUP_BACKEND = os.getenv('DEDUP_BACKEND', 'memory')
+DEDUP_WINDOW = int(os.getenv('DEDUP_WINDOW', 3600))
+DEDUP_MAX_SIZE = int(os.getenv('DEDUP_MAX_SIZE', 100000))
+
+
+class MemorySeenSet:
+    # This is a class that remembers the update IDs seen within the time window in process memory. The oldest IDs are
+    # dropped once the window passes or the size limit is reached.
+    def __init__(self, window=DEDUP_WINDOW, max_size=DEDUP_MAX_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self.seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, update_id):
+        # Marks the update ID as seen. It returns False if the ID was already seen within the window.
+        now = time.monotonic()
+        with self._lock:
+            while self.seen:
+                seen_at = next(iter(self.seen.values()))
+                if now - seen_at <= self.window and len(self.seen) < self.max_size:
+                    break
+                self.seen.popitem(last=False)
+            if update_id in self.seen:
+                return False
+            self.seen[update_id] = now
+            return True
+
+    def discard(self, update_id):
+        # Forgets the update ID, so the update is handled again when it is redelivered.
+        with self._lock:
+            self.seen.pop(update_id, None)
+
+
+class DatabaseSeenSet:
+    # This is a class that remembers the update IDs seen within the time window in the processed_updates table, so
+    # every process of a multi-process deployment shares the same set.
+    PURGE_INTERVAL = 60
+
+    def __init__(self, window=DEDUP_WINDOW):
+        self.window = window
+        self._last_purge = 0
+
+    def add(self, update_id):
+        # Marks the update ID as seen. It returns False if the ID was already inserted by any process.
+        self._purge()
+        try:
+            db.session.add(ProcessedUpdate(update_id=update_id))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+            return False
+
+    def discard(self, update_id):
+        # Deletes the row of the update ID. The transaction of the failed handling is rolled back first.
+        db.session.rollback()
+        ProcessedUpdate.query.filter_by(update_id=update_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    def _purge(self):
+        # Deletes the update IDs which are older than the window, at most once per purge interval.
+        now = time.monotonic()
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        expired = datetime.utcnow() - timedelta(seconds=self.window)
+        ProcessedUpdate.query.filter(ProcessedUpdate.processed_at < expired).delete(synchronize_session=False)
+        db.session.commit()
+
+
+class UpdateDeduplicator:
+    # This is a class that detects updates redelivered by Telegram, so they are acknowledged without being handled
+    # again. It counts hits (redelivered updates) and misses (new updates).
+    def __init__(self, seen_set):
+        self.seen_set = seen_set
+        self.hits = 0
+        self.misses = 0
+
+    def is_duplicate(self, update):
+        # Checks the update ID of the update and marks it as seen. Updates without an ID are never duplicates.
+        update_id = update.get('update_id')
+        if update_id is None:
+            return False
+        if self.seen_set.add(update_id):
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def forget(self, update):
+        # Unmarks an update whose handling failed, so Telegram's redelivery of it is handled instead of being
+        # acknowledged as a duplicate.
+        update_id = update.get('update_id')
+        if update_id is not None:
+            self.seen_set.discard(update_id)
+
+    def stats(self):
+        # Returns the hit and miss counters.
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+deduplicator = UpdateDeduplicator(DatabaseSeenSet() if DEDUP_BACKEND == 'db' else MemorySeenSet())
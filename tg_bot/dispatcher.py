@@ -0,0 +1,85 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+DISPATCH_MODE = os.getenv('DISPATCH_MODE', 'inline')
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', 8))
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDispatcher:
+    # This is a class that processes updates on a pool of worker threads. Every worker has its own queue and updates
+    # are routed to a worker by the sender's user ID, so the updates of one user are processed in order while updates
+    # of different users run in parallel.
+    def __init__(self, app, process, workers=DISPATCH_WORKERS):
+        self.app = app
+        self.process = process
+        self.workers = workers
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.busy_time = [0.0] * workers
+        self.processed = [0] * workers
+        self.failed = [0] * workers
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Starts the worker threads. It is called lazily on the first dispatch, so importing the module (or forking a
+        # server process) does not spawn threads.
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, args=(i,), name=f'tg-dispatcher-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        # Stops the worker threads after the updates already in the queues have been processed.
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for i, _ in enumerate(threads):
+            self.queues[i].put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def dispatch(self, user_id, update):
+        # Puts the update on the queue of the worker which owns the given user.
+        self.start()
+        self.queues[hash(user_id) % self.workers].put(update)
+
+    def stats(self):
+        # Returns the queue depth, busy time and number of processed updates of every worker.
+        return {
+            'queue_depth': sum(q.qsize() for q in self.queues),
+            'workers': [
+                {
+                    'queue_depth': self.queues[i].qsize(),
+                    'busy_seconds': round(self.busy_time[i], 6),
+                    'processed': self.processed[i],
+                    'failed': self.failed[i],
+                }
+                for i in range(self.workers)
+            ],
+        }
+
+    def _worker(self, index):
+        # Processes the updates of the worker's queue within an application context until a stop sentinel is
+        # received.
+        updates = self.queues[index]
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            start = time.perf_counter()
+            try:
+                with self.app.app_context():
+                    self.process(update)
+                self.processed[index] += 1
+            except Exception:
+                self.failed[index] += 1
+                logger.exception('Failed to process update %s', update.get('update_id'))
+            finally:
+                self.busy_time[index] += time.perf_counter() - start
@@ -1,82 +1,219 @@
+from . import metrics
+from .instrumentation import command_stats
+from . import callback_codec
+from . import contact_files
+from .sender import sender
 import requests
-from tg_bot import db
-from .models import User
-from dotenv import load_dotenv
+
+from .services import PAGE_SIZE, UserService, WeatherService, WeatherServiceException, ShopWizardService, ContactBookService, ContactBookException, ShopWizardException
 import os
+from collections import Counter
+import re
 
-from .services import WeatherService, WeatherServiceException, ShopWizardService, ContactBookService, ContactBookException, ShopWizardException
-import json
+WEATHER_TYPE = '/weather'
 
-load_dotenv()
+SERVICE_EXCEPTIONS = (ShopWizardException, ContactBookException, WeatherServiceException)
 
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-TG_BASE_URL = os.getenv('TG_BASE_URL')
+MESSAGE_LIMIT = 4096
 
-WEATHER_TYPE = '/weather'
+CONTACTS_IMPORT_MAX_SIZE = int(os.getenv('CONTACTS_IMPORT_MAX_SIZE', 20 * 1024 * 1024))
+
+# When true, the single reply of an update handled inline is returned as the webhook response instead of being sent.
+WEBHOOK_REPLIES = os.getenv('WEBHOOK_REPLIES', 'true').lower() == 'true'
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    # Splits a text into parts which fit into one Telegram message, preferring to split at line breaks.
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    chunks.append(text)
+    return chunks
 
 
 class TelegramHandler:
     user = None
 
-    def __init__(self, user_id):
-        self.user_id = user_id
-        self.user = User.query.get(user_id)
+    def __init__(self, data, collect=False):
+        # Resolves the user who sent the update once, so every service call of the update shares it. With collect the
+        # replies are kept in self.replies instead of being sent, see deliver_replies().
+        self.user_id = data['id']
+        self.user = UserService.get_or_create_user(data)
+        self.replies = [] if collect else None
 
-    def send_markup_message(self, text, markup):
-        # Sends a message with a custom markup to the user
+    def send_markup_message(self, text, markup, callback=None):
+        # Sends a message with a custom markup to the user. The message is queued on the shared sender and a Future
+        # with the Bot API response is returned (None while replies are collected). Texts over the message limit are
+        # split, and the markup is attached to the last part.
+        return self._send_text(text, {'reply_markup': markup}, callback)
+
+    def send_message(self, text, callback=None):
+        # Sends a simple text message to the user. The message is queued on the shared sender and a Future with the
+        # Bot API response is returned (None while replies are collected). Texts over the message limit are split into
+        # several messages.
+        return self._send_text(text, {}, callback)
+
+    def edit_markup_message(self, message_id, text, markup, callback=None):
+        # Replaces the text and the markup of a message sent to the user before, e.g. to show another page. A text over
+        # the message limit is split: the message is edited to hold the first part, and the other parts are sent as
+        # new messages, the last one with the markup.
+        chunks = split_message(text)
         data = {
-            'chat_id': self.user.id,
-            'text': text,
-            'reply_markup': markup
+            'chat_id': self.user_id,
+            'message_id': message_id,
+            'text': chunks[0]
         }
-        requests.post(f'{TG_BASE_URL}{BOT_TOKEN}/sendMessage', json=data)
+        calls = [('editMessageText', data)] + [('sendMessage', {'chat_id': self.user_id, 'text': chunk})
+                                               for chunk in chunks[1:]]
+        calls[-1][1]['reply_markup'] = markup
+        return self._submit(calls, callback)
 
-    def send_message(self, text):
-        # Sends a simple text message to the user
+    def send_document(self, file, file_name, mime_type, caption=None):
+        # Uploads a file to the user. It is always queued on the sender, as a file cannot be returned in the webhook
+        # response, and the file is closed once it is delivered.
         data = {
-            'chat_id': self.user.id,
-            'text': text
+            'chat_id': self.user_id
         }
-        requests.post(f'{TG_BASE_URL}{BOT_TOKEN}/sendMessage', json=data)
+        if caption:
+            data['caption'] = caption
+        return sender.submit('sendDocument', data, lambda future: file.close(),
+                             files={'document': (file_name, file, mime_type)})
 
-    @staticmethod
-    def set_suggestions(commands):
-        # Sets the suggestions for the user's input by providing a list of available commands
-        data = {
-            'commands': commands
+    def send_items_page(self, list_id, list_name, page, message_id=None):
+        # Sends a page of the items of a shop list, with buttons leading to the previous and the next page. When the
+        # page is requested from such a button, the message with the button is edited instead.
+        if not page.rows:
+            self._send_empty(f'List "{list_name}" is empty.', message_id)
+            return
+        item_list = "\n- ".join(name for _, name in page.rows)
+        text = f'Items in list "{list_name}":\n- {item_list}'
+        navigation = {'callback_type': '/items_page', 'l': list_id}
+        self._send_page(text, page, navigation, message_id)
+
+    def send_contacts_page(self, page, start=0, message_id=None):
+        # Sends a page of the contacts, numbered from start + 1, with buttons leading to the previous and the next
+        # page. When the page is requested from such a button, the message with the button is edited instead.
+        if not page.rows:
+            self._send_empty('Your contact book is empty.', message_id)
+            return
+        contacts = '\n'.join(f'{start + i + 1}. {first_name} {last_name}'
+                             for i, (_, first_name, last_name) in enumerate(page.rows))
+        text = f'Your contacts:\n{contacts}'
+        navigation = {'callback_type': '/contacts_page', 's': start}
+        self._send_page(text, page, navigation, message_id, len(page.rows))
+
+    def _send_empty(self, text, message_id=None):
+        # Tells the user that there is nothing to show. A message with page buttons is edited to drop its buttons.
+        if message_id:
+            self.edit_markup_message(message_id, text, {'inline_keyboard': []})
+        else:
+            self.send_message(text)
+
+    def _send_page(self, text, page, navigation, message_id=None, page_length=None):
+        buttons = []
+        if page.has_previous and page.rows:
+            previous = dict(navigation, b=page.rows[0][0])
+            if 's' in previous:
+                previous['s'] = max(previous['s'] - PAGE_SIZE, 0)
+            buttons.append({'text': '« Previous', 'callback_data': callback_codec.encode(**previous)})
+        if page.has_next and page.rows:
+            following = dict(navigation, a=page.rows[-1][0])
+            if 's' in following:
+                following['s'] += page_length
+            buttons.append({'text': 'Next »', 'callback_data': callback_codec.encode(**following)})
+        markup = {
+            'inline_keyboard': [buttons] if buttons else []
         }
-        requests.post(f'{TG_BASE_URL}{BOT_TOKEN}/setMyCommands', json=data)
+        if message_id:
+            self.edit_markup_message(message_id, text, markup)
+        elif buttons:
+            self.send_markup_message(text, markup)
+        else:
+            self.send_message(text)
+
+    def _send_text(self, text, extra, callback=None):
+        chunks = split_message(text)
+        calls = [('sendMessage', {'chat_id': self.user_id, 'text': chunk}) for chunk in chunks]
+        calls[-1][1].update(extra)
+        return self._submit(calls, callback)
+
+    def _submit(self, calls, callback=None):
+        # Collects the calls while replies are collected, unless the caller waits for the response through a callback,
+        # and queues them on the sender otherwise.
+        if self.replies is not None and callback is None:
+            self.replies.extend(calls)
+            return None
+        if len(calls) == 1:
+            return sender.submit(*calls[0], callback)
+        return sender.submit_sequence(calls, callback)
+
+
+class HandlerRegistry:
+    # This is a class that maps command names (or callback types) to the handler methods which implement them. Every
+    # entry declares the arguments it requires, a number of arguments for commands or the required keys for callbacks,
+    # and the usage message sent when they are missing.
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, name, required=0, usage=None):
+        # Registers the decorated method as the handler of the command with the given name.
+        def decorator(func):
+            self.handlers[name] = (func, required, usage)
+            return func
+        return decorator
+
+    def get(self, name):
+        # Returns the handler method, the required arguments and the usage message of the command.
+        return self.handlers.get(name)
 
 
 class MessageHandler(TelegramHandler):
-    def __init__(self, data):
-        # Initializes the TelegramHandler class with the user ID and retrieves the corresponding user from the database.
-        super().__init__(data['from']['id'])
-        self.user = User(**data['from'])
-        self.text = data.get('text')
-        self.city = None
+    commands = HandlerRegistry()
 
-        user = User.query.filter_by(id=self.user_id).first()
-        if not user:
-            new_user = User(id=self.user_id)
-            db.session.add(new_user)
-            db.session.commit()
+    def __init__(self, data, collect=False):
+        # Initializes the TelegramHandler class with the user ID and retrieves the corresponding user from the database.
+        super().__init__(data['from'], collect)
+        self.document = data.get('document')
+        # A file sent without the /import caption is imported too.
+        self.text = data.get('text') or data.get('caption') or ('/import' if self.document else None)
 
     def handle(self):
-        # Handles the received message by parsing the text and performing different actions based on the command or
-        # input, including interacting with the ShopWizardService, ContactBookService, and WeatherService.
-        text_parts = self.text.split()
-        if len(text_parts) > 1 and text_parts[0] == '/weather':
-            self.city = ' '.join(text_parts[1:])
-
-        if self.text == '/start':
-            welcome_message = "Welcome to the Shop Wizard Bot, where you can effortlessly create, edit, and remove " \
-                              "lists and items. Explore the convenience of managing your shopping essentials with " \
-                              "ease. Additionally, unlock the functionality to create your very own contact book and " \
-                              "stay informed about the weather in your city. To get started enter '/commands'."
-            self.send_message(welcome_message)
-        elif text_parts[0] == '/commands':
-            commands_message = '''
+        # Handles the received message by looking up the handler of its command and calling it with the command
+        # arguments. Every handled command is measured by command_stats.
+        text_parts = (self.text or '').split()
+        if not text_parts:
+            return
+        command = self.commands.get(text_parts[0])
+        metrics.updates_total.inc('message', text_parts[0] if command else 'unknown')
+        if not command:
+            return
+        func, required, usage = command
+        args = text_parts[1:]
+        with command_stats.measure(text_parts[0]):
+            if len(args) < required:
+                self.send_message(usage)
+                return
+            try:
+                func(self, args)
+            except SERVICE_EXCEPTIONS as e:
+                metrics.errors_total.inc(type(e).__name__)
+                self.send_message(str(e))
+
+    @commands.register('/start')
+    def start(self, args):
+        welcome_message = "Welcome to the Shop Wizard Bot, where you can effortlessly create, edit, and remove " \
+                          "lists and items. Explore the convenience of managing your shopping essentials with " \
+                          "ease. Additionally, unlock the functionality to create your very own contact book and " \
+                          "stay informed about the weather in your city. To get started enter '/commands'."
+        self.send_message(welcome_message)
+
+    @commands.register('/commands')
+    def help(self, args):
+        commands_message = '''
             Hello! This is the help center of Shop Wizard Bot. Here you can see how to use commands:
 
     /commands - See all available commands
@@ -84,12 +221,15 @@ class MessageHandler(TelegramHandler):
         /create_list - Create a new shopping list. Usage: /create_list <list_name>
         /remove_list - Remove an existing shopping list. Usage: /remove_list <list_name>
         /edit_list - Rename a shopping list. Usage: /edit_list <old_list_name> <new_list_name>
-        /add_item - Add an item to a shopping list. Usage: /add_item <list_name> <item>
+        /add_item - Add items to a shopping list. Usage: /add_item <list_name> <item>[, <item>...]
         /show_items - Show items in a shopping list. Usage: /show_items <list_name>
-        /remove_item - Remove an item from a shopping list. Usage: /remove_item <list_name> <item>
+        /lists - Show all your shopping lists with the number of items in each. Usage: /lists
+        /remove_item - Remove items from a shopping list. Usage: /remove_item <list_name> <item>[, <item>...]
 
     Weather Commands:
         /weather - Get the weather for a city. Usage: /weather <your_city>
+        /subscribe_weather - Get an alert when rain starts or stops in a city. Usage: /subscribe_weather <your_city>
+        /unsubscribe_weather - Stop the rain alerts for a city or all cities. Usage: /unsubscribe_weather [<your_city>]
 
     Contact Book Commands:
         /add - Add a new contact to your contact book. Usage: /add <first_name> <last_name> <contact_phone>
@@ -97,245 +237,338 @@ class MessageHandler(TelegramHandler):
         /show - Show the contact from your contact book. Usage: /show <first_name> <last_name>
         /list - Show the list of all your contacts. Usage: /list
         /delete - Delete a contact from a contact book. Usage: /delete <first_name> <last_name>
+        /find - Find contacts by the start of a name or phone number, typos allowed. Usage: /find <query>
+        /import - Import contacts from a CSV (first name, last name, phone number) or vCard file. Usage: send the file
+        /export - Export your contact book as a file. Usage: /export [csv|vcard]
 
+    Several items can be separated by commas or put on separate lines.
     Replace <list_name>, <item_name>, <your_city>, <first_name>, <last_name> with the actual names you want to use.'''
-            self.send_message(commands_message)
+        self.send_message(commands_message)
 
-        # ShopWizardService operations
-        elif text_parts[0] == '/create_list':
-            try:
-                if len(text_parts) < 2:
-                    raise ShopWizardException(
-                        'Insufficient arguments. Please provide list name.')
-                list_name = text_parts[1]
-                ShopWizardService.create_shop_list(self.user_id, list_name)
-                self.send_message(f'Shop list "{list_name}" created successfully!')
-            except ShopWizardException as e:
-                self.send_message(str(e))
-        elif text_parts[0] == '/remove_list':
-            try:
-                if len(text_parts) < 2:
-                    raise ShopWizardException(
-                        'Insufficient arguments. Please provide list name.')
-                list_name = text_parts[1]
-                ShopWizardService.remove_items_list(self.user_id, list_name)
-                ShopWizardService.remove_shop_list(self.user_id, list_name)
-                self.send_message(f'Shop list "{list_name}" and its items removed successfully!')
-            except ShopWizardException as e:
-                self.send_message(str(e))
-        elif text_parts[0] == '/edit_list':
-            try:
-                if len(text_parts) < 3:
-                    raise ShopWizardException(
-                        'Insufficient arguments. Please provide both the old list name and new list name.')
-                old_list_name = text_parts[1]
-                new_list_name = text_parts[2]
-                ShopWizardService.edit_shop_list(self.user_id, old_list_name, new_list_name)
-                self.send_message(f'Shop list "{old_list_name}" renamed to "{new_list_name}" successfully!')
-            except ShopWizardException as e:
-                self.send_message(str(e))
-        elif text_parts[0] == '/add_item':
-            try:
-                if len(text_parts) < 3:
-                    raise ShopWizardException(
-                        'Insufficient arguments. Please provide list name and item name.')
-                list_name = text_parts[1]
-                item = ' '.join(text_parts[2:])
-                ShopWizardService.add_item_to_list(self.user_id, list_name, item)
-                self.send_message(f'Item "{item}" added to list "{list_name}" successfully!')
-            except ShopWizardException as e:
-                self.send_message(str(e))
-        elif text_parts[0] == '/show_items':
-            try:
-                if len(text_parts) < 2:
-                    raise ShopWizardException(
-                        'Insufficient arguments. Please provide list name.')
-                list_name = text_parts[1]
-                items = ShopWizardService.show_list_items(self.user_id, list_name)
-                if items:
-                    item_list = "\n- ".join(items)
-                    self.send_message(f'Items in list "{list_name}":\n- {item_list}')
-                else:
-                    self.send_message(f'List "{list_name}" is empty.')
-            except ShopWizardException as e:
-                self.send_message(str(e))
-        elif text_parts[0] == '/remove_item':
-            try:
-                if len(text_parts) < 3:
-                    raise ShopWizardException(
-                        'Insufficient arguments. Please provide list name and item name.')
-                list_name = text_parts[1]
-                item = ' '.join(text_parts[2:])
-                ShopWizardService.remove_item_from_list(self.user_id, list_name, item)
-                self.send_message(f'Item "{item}" removed from list "{list_name}" successfully!')
-            except ShopWizardException as e:
-                self.send_message(str(e))
+    # ShopWizardService operations
+    @commands.register('/create_list', 1, 'Insufficient arguments. Please provide list name.')
+    def create_list(self, args):
+        list_name = args[0]
+        ShopWizardService.create_shop_list(self.user, list_name)
+        self.send_message(f'Shop list "{list_name}" created successfully!')
 
-        # ContactBookService commands
-        elif text_parts[0] == '/add':
-            try:
-                if len(text_parts) < 4:
-                    raise ContactBookException(
-                        'Insufficient arguments. Please provide first name, last name and phone number.')
-                first_name = text_parts[1]
-                last_name = text_parts[2]
-                phone_number = text_parts[3]
-                ContactBookService.add_contact(self.user_id, first_name, last_name, phone_number)
-                self.send_message(f'Contact "{first_name} {last_name}" added successfully!')
-            except ContactBookException as e:
-                self.send_message(str(e))
-        elif text_parts[0] == '/delete':
-            try:
-                if len(text_parts) < 3:
-                    raise ContactBookException(
-                        'Insufficient arguments. Please provide both the first name and last name.')
-
-                first_name = text_parts[1]
-                last_name = text_parts[2]
-                ContactBookService.delete_contact(self.user_id, first_name, last_name)
-                self.send_message(f'Contact "{first_name} {last_name}" deleted successfully!')
-            except ContactBookException as e:
-                self.send_message(str(e))
-        elif text_parts[0] == '/status':
-            try:
-                count = ContactBookService.status(self.user_id)
-                self.send_message(f'You have {count} contact{"s" if count != 1 else ""} in your contact book.')
-            except ContactBookException as e:
-                self.send_message(str(e))
-        elif text_parts[0] == '/list':
-            try:
-                contacts = ContactBookService.list_of_contacts(self.user_id)
-                if contacts:
-                    self.send_message(f'Your contacts:\n{contacts}')
-                else:
-                    self.send_message('Your contact book is empty.')
-            except ContactBookException as e:
-                self.send_message(str(e))
-        elif text_parts[0] == '/show':
-            try:
-                if len(text_parts) < 3:
-                    raise ContactBookException(
-                        'Insufficient arguments. Please provide both the first name and last name.')
-                first_name = text_parts[1]
-                last_name = text_parts[2]
-                contact = ContactBookService.show_contact(self.user_id, first_name, last_name)
-                if contact:
-                    contact_info = f'Information about {contact.first_name}:\n' \
-                                   f'Name - {contact.first_name} {contact.last_name}\n' \
-                                   f'Phone number - {contact.phone_number}'
-                    self.send_message(contact_info)
-                else:
-                    self.send_message(f'Contact "{first_name} {last_name}" not found.')
-            except ContactBookException as e:
-                self.send_message(str(e))
+    @commands.register('/remove_list', 1, 'Insufficient arguments. Please provide list name.')
+    def remove_list(self, args):
+        list_name = args[0]
+        items_count = ShopWizardService.remove_shop_list(self.user, list_name)
+        self.send_message(f'Shop list "{list_name}" and its {items_count} '
+                          f'item{"s" if items_count != 1 else ""} removed successfully!')
 
-        # WeatherService commands
-        elif text_parts[0] == '/weather':
-            try:
-                geo_data = WeatherService.get_geo_data(self.city)
-                buttons = []
-                for item in geo_data:
-                    test_button = {
-                        'text': f'{item.get("name")} - {item.get("country_code")}',
-                        'callback_data': json.dumps({
-                            'type': '/weather_city',
-                            'lat': item.get('latitude'),
-                            'lon': item.get('longitude')
-                        })
-                    }
-                    buttons.append([test_button])
-                markup = {
-                    'inline_keyboard': buttons
-                }
-                self.send_markup_message(f'Choose a city from the list:', markup)
-            except WeatherServiceException as wse:
-                self.send_message(str(wse))
-        commands = [
-            {'command': '/commands', 'description': 'Get to know the available commands'},
-            {'command': '/weather', 'description': 'Get the weather for a city'},
-            {'command': '/status', 'description': 'Get the amount of contacts'},
-            {'command': '/list', 'description': 'Get the list of contacts'},
-        ]
-        self.set_suggestions(commands)
+    @commands.register('/edit_list', 2,
+                       'Insufficient arguments. Please provide both the old list name and new list name.')
+    def edit_list(self, args):
+        old_list_name = args[0]
+        new_list_name = args[1]
+        ShopWizardService.edit_shop_list(self.user, old_list_name, new_list_name)
+        self.send_message(f'Shop list "{old_list_name}" renamed to "{new_list_name}" successfully!')
+
+    @commands.register('/add_item', 2, 'Insufficient arguments. Please provide list name and item name.')
+    def add_item(self, args):
+        list_name = args[0]
+        items = ShopWizardService.add_items_to_list(self.user, list_name, self.parse_items())
+        if len(items) == 1:
+            self.send_message(f'Item "{items[0]}" added to list "{list_name}" successfully!')
+        else:
+            self.send_message(f'{len(items)} items added to list "{list_name}" successfully: '
+                              f'{", ".join(items)}')
+
+    @commands.register('/show_items', 1, 'Insufficient arguments. Please provide list name.')
+    def show_items(self, args):
+        list_name = args[0]
+        list_id, page = ShopWizardService.show_list_items(self.user, list_name)
+        self.send_items_page(list_id, list_name, page)
+
+    @commands.register('/lists')
+    def lists(self, args):
+        shop_lists = ShopWizardService.shop_lists(self.user)
+        if not shop_lists:
+            self.send_message('You have no shop lists yet. Create one with /create_list <list_name>.')
+            return
+        lines = '\n'.join(f'- {list_name} ({item_count} item{"s" if item_count != 1 else ""})'
+                          for list_name, item_count in shop_lists)
+        self.send_message(f'Your shop lists:\n{lines}')
+
+    @commands.register('/remove_item', 2, 'Insufficient arguments. Please provide list name and item name.')
+    def remove_item(self, args):
+        list_name = args[0]
+        items = self.parse_items()
+        if len(items) == 1:
+            ShopWizardService.remove_item_from_list(self.user, list_name, items[0])
+            self.send_message(f'Item "{items[0]}" removed from list "{list_name}" successfully!')
+        else:
+            removed, not_found = ShopWizardService.remove_items_from_list(self.user, list_name, items)
+            message = f'{len(removed)} item{"s" if len(removed) != 1 else ""} removed from list "{list_name}" ' \
+                      f'successfully: {", ".join(removed)}'
+            if not_found:
+                missing = (name if count == 1 else f'{name} (x{count})' for name, count in Counter(not_found).items())
+                message += f'\nNot found in the list: {", ".join(missing)}'
+            self.send_message(message)
+
+    # ContactBookService commands
+    @commands.register('/add', 3, 'Insufficient arguments. Please provide first name, last name and phone number.')
+    def add_contact(self, args):
+        first_name = args[0]
+        last_name = args[1]
+        phone_number = args[2]
+        ContactBookService.add_contact(self.user, first_name, last_name, phone_number)
+        self.send_message(f'Contact "{first_name} {last_name}" added successfully!')
+
+    @commands.register('/delete', 2, 'Insufficient arguments. Please provide both the first name and last name.')
+    def delete_contact(self, args):
+        first_name = args[0]
+        last_name = args[1]
+        ContactBookService.delete_contact(self.user, first_name, last_name)
+        self.send_message(f'Contact "{first_name} {last_name}" deleted successfully!')
+
+    @commands.register('/status')
+    def status(self, args):
+        count = ContactBookService.status(self.user)
+        self.send_message(f'You have {count} contact{"s" if count != 1 else ""} in your contact book.')
+
+    @commands.register('/list')
+    def list_contacts(self, args):
+        page = ContactBookService.list_of_contacts(self.user)
+        self.send_contacts_page(page)
+
+    @commands.register('/show', 2, 'Insufficient arguments. Please provide both the first name and last name.')
+    def show_contact(self, args):
+        first_name = args[0]
+        last_name = args[1]
+        contact = ContactBookService.show_contact(self.user, first_name, last_name)
+        if contact:
+            contact_info = f'Information about {contact.first_name}:\n' \
+                           f'Name - {contact.first_name} {contact.last_name}\n' \
+                           f'Phone number - {contact.phone_number}'
+            self.send_message(contact_info)
+        else:
+            self.send_message(f'Contact "{first_name} {last_name}" not found.')
+
+    @commands.register('/find', 1, 'Insufficient arguments. Please provide a name or phone number to search for.')
+    def find_contacts(self, args):
+        query = ' '.join(args)
+        contacts = ContactBookService.find_contacts(self.user, query)
+        if contacts:
+            contact_list = '\n'.join(f'{i + 1}. {first_name} {last_name} - {phone_number}'
+                                     for i, (_, first_name, last_name, phone_number) in enumerate(contacts))
+            self.send_message(f'Contacts matching "{query}":\n{contact_list}')
+        else:
+            self.send_message(f'No contacts match "{query}".')
+
+    @commands.register('/import')
+    def import_contacts(self, args):
+        if not self.document:
+            self.send_message('Send a CSV file with first name, last name and phone number columns or a vCard file to '
+                              'import contacts.')
+            return
+        if (self.document.get('file_size') or 0) > CONTACTS_IMPORT_MAX_SIZE:
+            self.send_message(f'The file is too large. Files up to {CONTACTS_IMPORT_MAX_SIZE // 1024 // 1024} MB can '
+                              f'be imported.')
+            return
+        contact_format = contact_files.detect_format(self.document.get('file_name'), self.document.get('mime_type'))
+        try:
+            with sender.download(self.document['file_id']) as response:
+                lines = (line.decode('utf-8-sig' if i == 0 else 'utf-8')
+                         for i, line in enumerate(response.iter_lines()))
+                rows = contact_files.parse(lines, contact_format)
+                imported, duplicates, invalid = ContactBookService.import_contacts(self.user, rows)
+        except requests.RequestException:
+            self.send_message('Cannot download the file. Please try again.')
+            return
+        message = f'{imported} contact{"s" if imported != 1 else ""} imported successfully!'
+        if duplicates:
+            message += f'\nSkipped {duplicates} already in your contact book.'
+        if invalid:
+            message += f'\nSkipped {invalid} without a first name, last name or phone number, or too long.'
+        self.send_message(message)
+
+    @commands.register('/export')
+    def export_contacts(self, args):
+        contact_format = args[0].lower() if args else 'csv'
+        if contact_format not in contact_files.FORMATS:
+            self.send_message('Unknown format. Usage: /export [csv|vcard]')
+            return
+        file, count = ContactBookService.export_contacts(self.user, contact_format)
+        extension, mime_type = contact_files.FORMATS[contact_format]
+        self.send_document(file, f'contacts.{extension}', mime_type,
+                           f'{count} contact{"s" if count != 1 else ""} exported.')
+
+    # WeatherService commands
+    @commands.register(WEATHER_TYPE, 1, 'Insufficient arguments. Please provide city name.')
+    def weather(self, args):
+        geo_data = WeatherService.get_geo_data(' '.join(args))
+        buttons = []
+        for item in geo_data:
+            test_button = {
+                'text': f'{item.get("name")} - {item.get("country_code")}',
+                'callback_data': callback_codec.encode('/weather_city', lat=item.get('latitude'),
+                                                       lon=item.get('longitude'))
+            }
+            buttons.append([test_button])
+        markup = {
+            'inline_keyboard': buttons
+        }
+        self.send_markup_message(f'Choose a city from the list:', markup)
+
+    @commands.register('/subscribe_weather', 1, 'Insufficient arguments. Please provide city name.')
+    def subscribe_weather(self, args):
+        city_name = WeatherService.subscribe(self.user, ' '.join(args))
+        self.send_message(f'You will get an alert when rain starts or stops in {city_name}.')
+
+    @commands.register('/unsubscribe_weather')
+    def unsubscribe_weather(self, args):
+        count = WeatherService.unsubscribe(self.user, ' '.join(args))
+        self.send_message(f'{count} rain alert subscription{"s" if count != 1 else ""} removed.')
+
+    def parse_items(self):
+        # Returns the item names of an /add_item or /remove_item message. Items follow the list name and are separated
+        # by commas or new lines.
+        parts = self.text.split(maxsplit=2)
+        if len(parts) < 3:
+            return []
+        items = (' '.join(item.split()) for item in re.split(r'[,\n]', parts[2]))
+        return [item for item in items if item]
 
 
 class CallBackHandler(TelegramHandler):
-    def __init__(self, data):
+    callbacks = HandlerRegistry()
+
+    def __init__(self, data, collect=False):
         # Initializes the CallBackHandler class with the received callback data, including the user ID and callback
         # information.
-        super().__init__(data['from']['id'])
-        self.user = User(**data.get('from'))
-        self.callback_data = json.loads(data.get('data'))
+        super().__init__(data['from'], collect)
+        self.callback_data = callback_codec.decode(data.get('data'))
+        self.message_id = (data.get('message') or {}).get('message_id')
 
     def handle(self):
-        # Handles the received callback by parsing the callback data and performing different actions based on the
-        # callback type, including interacting with the ShopWizardService and WeatherService.
-        callback_type = self.callback_data.pop('type')
-        if '/create_list' in self.callback_data:
-            try:
-                user_id = self.user.id
-                list_name = self.callback_data['list_name']
-                ShopWizardService.create_shop_list(user_id, list_name)
-                self.send_message(f'Shop list "{list_name}" created successfully!')
-            except ShopWizardException as e:
-                self.send_message(str(e))
-        elif '/remove_list' in self.callback_data:
-            try:
-                user_id = self.user.id
-                list_name = self.callback_data.split()[1]
-                ShopWizardService.remove_items_list(user_id, list_name)
-                ShopWizardService.remove_shop_list(user_id, list_name)
-                self.send_message(f'Shop list "{list_name}" and its items removed successfully!')
-            except ShopWizardException as e:
-                self.send_message(str(e))
-        elif '/edit_list' in self.callback_data:
+        # Handles the received callback by looking up the handler of its callback type and calling it with the
+        # callback data. Every handled callback is measured by command_stats.
+        if self.callback_data is None:
+            metrics.updates_total.inc('callback_query', 'expired')
+            self.send_message('This button has expired. Please run the command again.')
+            return
+        callback_type = self.callback_data.pop('type', None)
+        callback = self.callbacks.get(callback_type)
+        metrics.updates_total.inc('callback_query', callback_type if callback else 'unknown')
+        if not callback:
+            return
+        func, required, usage = callback
+        with command_stats.measure(f'callback:{callback_type}'):
+            if any(key not in self.callback_data for key in required):
+                self.send_message(usage)
+                return
             try:
-                user_id = self.user.id
-                old_list_name = self.callback_data['old_list_name']
-                new_list_name = self.callback_data['new_list_name']
-                ShopWizardService.edit_shop_list(user_id, old_list_name, new_list_name)
-                self.send_message(f'Shop list "{old_list_name}" renamed to "{new_list_name}" successfully!')
-            except ShopWizardException as e:
+                func(self, self.callback_data)
+            except SERVICE_EXCEPTIONS as e:
+                metrics.errors_total.inc(type(e).__name__)
                 self.send_message(str(e))
-        elif '/add_item' in self.callback_data:
-            try:
-                user_id = self.user.id
-                list_name = self.callback_data['list_name']
-                item = self.callback_data['item']
-                ShopWizardService.add_item_to_list(user_id, list_name, item)
-                self.send_message(f'Item "{item}" added to list "{list_name}" successfully!')
-            except ShopWizardException as e:
-                self.send_message(str(e))
-        elif '/show_items' in self.callback_data:
-            try:
-                user_id = self.user.id
-                list_name = self.callback_data['list_name']
-                items = ShopWizardService.show_list_items(user_id, list_name)
-                if items:
-                    item_list = "\n- ".join(items)
-                    self.send_message(f'Items in list "{list_name}":\n- {item_list}')
-                else:
-                    self.send_message(f'List "{list_name}" is empty.')
-            except ShopWizardException as e:
-                self.send_message(str(e))
-        if callback_type == '/weather_city':
-            try:
-                lat = self.callback_data.get('lat')
-                lon = self.callback_data.get('lon')
-                weather = WeatherService.get_current_weather_by_geo_data(lat, lon)
-                temperature = weather.get('temperature')
-                rain_status = weather.get('rain')
-                response_message = f'The current temperature in your city is {temperature}°C.\n'
-                if rain_status:
-                    response_message += 'It is currently raining in your city.'
-                else:
-                    response_message += 'There is no rain in your city at the moment.'
-                self.send_message(response_message)
-            except WeatherServiceException as wse:
-                self.send_message(str(wse))
+
+    @callbacks.register('/create_list', ('list_name',), 'Invalid callback data. Please provide list name.')
+    def create_list(self, data):
+        list_name = data['list_name']
+        ShopWizardService.create_shop_list(self.user, list_name)
+        self.send_message(f'Shop list "{list_name}" created successfully!')
+
+    @callbacks.register('/remove_list', ('list_name',), 'Invalid callback data. Please provide list name.')
+    def remove_list(self, data):
+        list_name = data['list_name']
+        items_count = ShopWizardService.remove_shop_list(self.user, list_name)
+        self.send_message(f'Shop list "{list_name}" and its {items_count} '
+                          f'item{"s" if items_count != 1 else ""} removed successfully!')
+
+    @callbacks.register('/edit_list', ('old_list_name', 'new_list_name'),
+                        'Invalid callback data. Please provide both the old list name and new list name.')
+    def edit_list(self, data):
+        old_list_name = data['old_list_name']
+        new_list_name = data['new_list_name']
+        ShopWizardService.edit_shop_list(self.user, old_list_name, new_list_name)
+        self.send_message(f'Shop list "{old_list_name}" renamed to "{new_list_name}" successfully!')
+
+    @callbacks.register('/add_item', ('list_name', 'item'),
+                        'Invalid callback data. Please provide list name and item name.')
+    def add_item(self, data):
+        list_name = data['list_name']
+        item = data['item']
+        ShopWizardService.add_item_to_list(self.user, list_name, item)
+        self.send_message(f'Item "{item}" added to list "{list_name}" successfully!')
+
+    @callbacks.register('/show_items', ('list_name',), 'Invalid callback data. Please provide list name.')
+    def show_items(self, data):
+        list_name = data['list_name']
+        list_id, page = ShopWizardService.show_list_items(self.user, list_name)
+        self.send_items_page(list_id, list_name, page)
+
+    @callbacks.register('/items_page', ('l',), 'Invalid callback data. Please show the list again.')
+    def items_page(self, data):
+        list_name, page = ShopWizardService.show_list_items_by_id(self.user, data['l'], data.get('a'), data.get('b'))
+        if not page.rows:
+            # The items of the page were removed meanwhile, so the first page is shown instead.
+            list_name, page = ShopWizardService.show_list_items_by_id(self.user, data['l'])
+        self.send_items_page(data['l'], list_name, page, self.message_id)
+
+    @callbacks.register('/contacts_page', ('s',), 'Invalid callback data. Please show the contacts again.')
+    def contacts_page(self, data):
+        page = ContactBookService.list_of_contacts(self.user, data.get('a'), data.get('b'))
+        start = data['s']
+        if not page.rows:
+            # The contacts of the page were deleted meanwhile, so the first page is shown instead.
+            page, start = ContactBookService.list_of_contacts(self.user), 0
+        self.send_contacts_page(page, start, self.message_id)
+
+    @callbacks.register('/weather_city', ('lat', 'lon'), 'Invalid callback data. Please choose the city again.')
+    def weather_city(self, data):
+        weather = WeatherService.get_current_weather_by_geo_data(data['lat'], data['lon'])
+        temperature = weather.get('temperature')
+        rain_status = weather.get('rain')
+        response_message = f'The current temperature in your city is {temperature}°C.\n'
+        if rain_status:
+            response_message += 'It is currently raining in your city.'
+        else:
+            response_message += 'There is no rain in your city at the moment.'
+        self.send_message(response_message)
 
     @staticmethod
     def formatting_weather(weather):
         # Formats the weather information received from the WeatherService into a readable message.
         formatted_weather = f'Current temperature in your city is {weather["temperature"]}°C.'
         return formatted_weather
+
+
+def get_update_sender_id(update):
+    # Returns the ID of the user who sent the update, or None if the update is not supported by the bot.
+    payload = update.get('message') or update.get('callback_query')
+    if payload and payload.get('from'):
+        return payload['from'].get('id')
+    return None
+
+
+def handle_update(update, collect=False):
+    # Builds the handler for the received update and handles it. With collect the replies are not sent but returned
+    # as a list of (method, payload) Bot API calls.
+    if message := update.get('message'):
+        handler = MessageHandler(message, collect)
+    elif callback := update.get('callback_query'):
+        handler = CallBackHandler(callback, collect)
+    else:
+        return [] if collect else None
+    handler.handle()
+    return handler.replies
+
+
+def deliver_replies(replies):
+    # Delivers the replies collected for an update. A single reply is returned as the body for the webhook response,
+    # in which Telegram accepts one Bot API call, so it needs no request of its own. It takes its tokens from the
+    # sender's flood limits like any other call; when none are available now, and for several replies, which must
+    # keep their order, the replies are sent by the sender instead, which waits for the limits and retries 429s.
+    if len(replies) == 1:
+        method, payload = replies[0]
+        if sender.take_inline(payload.get('chat_id')):
+            metrics.webhook_replies.inc()
+            return dict(payload, method=method)
+    if replies:
+        sender.submit_sequence(replies)
+    return None
@@ -0,0 +1,100 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import metrics
+
+_local = threading.local()
+
+
+class CommandStats:
+    # This is a class that aggregates the wall time, the database time and the outbound HTTP time of every handled
+    # command. The database and HTTP time are collected on the thread which handles the command. The wall time is
+    # also observed by the command duration histogram of the /metrics endpoint.
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, command):
+        # Measures the handling of a command within the block.
+        timing = _local.timing = {'db': 0.0, 'http': 0.0, 'queries': 0}
+        start = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            wall = time.perf_counter() - start
+            _local.timing = None
+            self.record(command, wall, timing)
+
+    def record(self, command, wall, timing):
+        # Adds one measurement to the statistics of the command.
+        with self._lock:
+            stats = self.stats.get(command)
+            if stats is None:
+                stats = self.stats[command] = {'count': 0, 'wall': 0.0, 'wall_max': 0.0, 'db': 0.0, 'http': 0.0,
+                                               'queries': 0}
+            stats['count'] += 1
+            stats['wall'] += wall
+            stats['wall_max'] = max(stats['wall_max'], wall)
+            stats['db'] += timing['db']
+            stats['http'] += timing['http']
+            stats['queries'] += timing['queries']
+        metrics.command_duration.observe(wall, command)
+
+    def snapshot(self):
+        # Returns the number of calls and the mean wall, database and HTTP time in milliseconds of every command.
+        with self._lock:
+            return {
+                command: {
+                    'count': stats['count'],
+                    'wall_ms': round(stats['wall'] / stats['count'] * 1000, 3),
+                    'wall_max_ms': round(stats['wall_max'] * 1000, 3),
+                    'db_ms': round(stats['db'] / stats['count'] * 1000, 3),
+                    'http_ms': round(stats['http'] / stats['count'] * 1000, 3),
+                    'queries': round(stats['queries'] / stats['count'], 2),
+                }
+                for command, stats in self.stats.items()
+            }
+
+
+def _current_timing():
+    return getattr(_local, 'timing', None)
+
+
+@contextmanager
+def measure_http(target):
+    # Adds the duration of the outbound HTTP request made within the block to the command being handled and to the
+    # outbound request histogram of the target. The block sets the 'status' key of the yielded dict to the status code
+    # of the response; a request which raised is recorded with the status 'error'.
+    outcome = {'status': 'error'}
+    start = time.perf_counter()
+    try:
+        yield outcome
+    finally:
+        duration = time.perf_counter() - start
+        metrics.outbound_requests.observe(duration, target, outcome['status'])
+        timing = _current_timing()
+        if timing is not None:
+            timing['http'] += duration
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context._query_start
+    metrics.db_queries.observe(duration)
+    timing = _current_timing()
+    if timing is not None:
+        timing['db'] += duration
+        timing['queries'] += 1
+
+
+command_stats = CommandStats()
@@ -0,0 +1,129 @@
+import threading
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    # This is a class that counts events per combination of label values.
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    # This is a class that counts observed values in cumulative buckets per combination of label values.
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {labels: (list(counts), total, count) for labels, (counts, total, count) in self.values.items()}
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                le = bound if bound == '+Inf' else repr(float(bound))
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, labels, [("le", le)])} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}'
+
+
+class Gauge:
+    # This is a class that reports the current value returned by a function when the metrics are collected.
+    type = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        yield f'{self.name} {self.function()}'
+
+
+class MetricsRegistry:
+    # This is a class that collects the metrics of the bot and renders them in the Prometheus text format.
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+updates_total = registry.register(Counter(
+    'tg_bot_updates_total', 'Handled updates by update type and command.', ('type', 'command')))
+command_duration = registry.register(Histogram(
+    'tg_bot_command_duration_seconds', 'Time spent handling a command.', ('command',)))
+db_queries = registry.register(Histogram(
+    'tg_bot_db_query_duration_seconds', 'Duration of the SQL statements executed by the bot.'))
+db_reads = registry.register(Counter(
+    'tg_bot_db_reads_total', 'Service reads by the database they were routed to.', ('target',)))
+outbound_requests = registry.register(Histogram(
+    'tg_bot_outbound_request_duration_seconds', 'Duration of outbound HTTP requests by target and status code.',
+    ('target', 'status')))
+sender_wait = registry.register(Histogram(
+    'tg_bot_sender_wait_seconds', 'Time a queued Bot API call waited for a worker and the flood limits.',
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)))
+sender_retries = registry.register(Counter(
+    'tg_bot_sender_retries_total', 'Bot API calls retried after a 429 Too Many Requests response.'))
+webhook_replies = registry.register(Counter(
+    'tg_bot_webhook_replies_total', 'Replies returned in the webhook response instead of a Bot API request.'))
+weather_alerts = registry.register(Counter(
+    'tg_bot_weather_alerts_total', 'Rain alerts sent to subscribers by the new state of the weather.', ('state',)))
+callback_tokens = registry.register(Counter(
+    'tg_bot_callback_tokens_total', 'Callback data kept in the token store, by issued and expired tokens.',
+    ('result',)))
+errors_total = registry.register(Counter(
+    'tg_bot_errors_total', 'Service exceptions reported to users by exception class.', ('exception',)))
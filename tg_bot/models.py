@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from tg_bot import db
 
 
@@ -9,6 +11,10 @@ class User(db.Model):
     username = db.Column(db.String(100))
     is_bot = db.Column(db.Boolean, default=False)
     language_code = db.Column(db.String(10))
+    # The number of contacts of the user, kept up to date by ContactBookService and recomputed by 'flask recount'.
+    contact_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Incremented by every change of the contacts of the user, so the search indexes of every process notice it.
+    contacts_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def __repr__(self):
         return f"User(id={self.id}, first_name='{self.first_name}', last_name='{self.last_name}', " \
@@ -17,9 +23,14 @@ class User(db.Model):
 
 class ShopList(db.Model):
     __tablename__ = 'shop_lists'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'list_name', name='uq_shop_lists_user_id_list_name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     list_name = db.Column(db.String(100), nullable=False)
+    # The number of items of the list, kept up to date by ShopWizardService and recomputed by 'flask recount'.
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def __repr__(self):
         return f"ShopList(id={self.id}, user_id={self.id}, list_id={self.list_id})"
@@ -27,11 +38,14 @@ class ShopList(db.Model):
 
 class Item(db.Model):
     __tablename__ = 'items'
+    __table_args__ = (
+        db.Index('ix_items_list_id_name', 'list_id', 'name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    list_id = db.Column(db.Integer, db.ForeignKey('shop_lists.id'), nullable=False)
+    list_id = db.Column(db.Integer, db.ForeignKey('shop_lists.id', ondelete='CASCADE'), nullable=False)
 
-    list = db.relationship('ShopList', backref=db.backref('items', lazy=True))
+    list = db.relationship('ShopList', backref=db.backref('items', lazy=True, passive_deletes=True))
 
     def __repr__(self):
         return f"Item(id={self.id}, name='{self.name}', list_id={self.list_id})"
@@ -39,6 +53,9 @@ class Item(db.Model):
 
 class ContactBook(db.Model):
     __tablename__ = 'contact_book'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'first_name', 'last_name', name='uq_contact_book_user_id_first_name_last_name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(100), nullable=False)
     last_name = db.Column(db.String(100), nullable=False)
@@ -50,3 +67,39 @@ class ContactBook(db.Model):
     def __repr__(self):
         return f"ContactBook(id={self.id}, first_name='{self.first_name}', last_name='{self.last_name}', " \
                f"phone_number='{self.phone_number}', user_id={self.user_id})"
+
+
+class ProcessedUpdate(db.Model):
+    __tablename__ = 'processed_updates'
+    update_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    processed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"ProcessedUpdate(update_id={self.update_id}, processed_at={self.processed_at})"
+
+
+class WeatherSubscription(db.Model):
+    __tablename__ = 'weather_subscriptions'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'city_name', name='uq_weather_subscriptions_user_id_city_name'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    city_name = db.Column(db.String(100), nullable=False)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    is_raining = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return f"WeatherSubscription(id={self.id}, user_id={self.user_id}, city_name='{self.city_name}', " \
+               f"latitude={self.latitude}, longitude={self.longitude}, is_raining={self.is_raining})"
+
+
+class ScheduledRun(db.Model):
+    __tablename__ = 'scheduled_runs'
+    job = db.Column(db.String(50), primary_key=True)
+    slot = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    ran_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"ScheduledRun(job='{self.job}', slot={self.slot}, ran_at={self.ran_at})"
@@ -0,0 +1,90 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from tg_bot import app
+from .handlers import get_update_sender_id, handle_update
+from .sender import sender
+
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', 30))
+POLL_LIMIT = int(os.getenv('POLL_LIMIT', 100))
+POLL_CONCURRENCY = int(os.getenv('POLL_CONCURRENCY', 8))
+
+logger = logging.getLogger(__name__)
+
+
+class UpdatePoller:
+    # This is a class that receives updates by long polling getUpdates instead of the webhook. Every call pulls up to
+    # POLL_LIMIT updates, which are handled through the same MessageHandler/CallBackHandler pipeline as the webhook.
+    # Updates of one user are handled in order, the updates of different users in parallel up to the concurrency
+    # limit.
+    def __init__(self, timeout=POLL_TIMEOUT, limit=POLL_LIMIT, concurrency=POLL_CONCURRENCY):
+        self.timeout = timeout
+        self.limit = limit
+        self.concurrency = concurrency
+        self.offset = None
+        self.processed = 0
+        self.failed = 0
+        self.running = False
+        self._lock = threading.Lock()
+
+    def get_updates(self):
+        # Long polls getUpdates from the current offset and returns the received updates.
+        data = {
+            'timeout': self.timeout,
+            'limit': self.limit,
+        }
+        if self.offset is not None:
+            data['offset'] = self.offset
+        res = sender.call('getUpdates', data, timeout=self.timeout + 10)
+        if res.status_code != 200:
+            raise requests.HTTPError(f'getUpdates failed with status {res.status_code}', response=res)
+        return res.json().get('result', [])
+
+    def process_batch(self, updates, executor):
+        # Handles a batch of updates and moves the offset past it. The updates are grouped by user, so every group is
+        # handled sequentially on one thread of the executor.
+        groups = {}
+        for update in updates:
+            user_id = get_update_sender_id(update)
+            if user_id is not None:
+                groups.setdefault(user_id, []).append(update)
+        for future in [executor.submit(self._process_group, group) for group in groups.values()]:
+            future.result()
+        if updates:
+            self.offset = max(update['update_id'] for update in updates) + 1
+
+    def run(self, max_batches=None):
+        # Polls and handles updates until stop() is called or max_batches batches were received.
+        self.running = True
+        batches = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='tg-poller') as executor:
+            while self.running and (max_batches is None or batches < max_batches):
+                try:
+                    updates = self.get_updates()
+                except requests.RequestException:
+                    logger.exception('Failed to get updates')
+                    time.sleep(1)
+                    continue
+                self.process_batch(updates, executor)
+                batches += 1
+
+    def stop(self):
+        # Stops polling after the batch in progress.
+        self.running = False
+
+    def _process_group(self, updates):
+        with app.app_context():
+            for update in updates:
+                try:
+                    handle_update(update)
+                    with self._lock:
+                        self.processed += 1
+                except Exception:
+                    with self._lock:
+                        self.failed += 1
+                    logger.exception('Failed to process update %s', update.get('update_id'))
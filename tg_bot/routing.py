@@ -0,0 +1,150 @@
+import contextvars
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from . import metrics
+from .cache import create_cache_backend
+
+# Comma-separated URIs of read replicas of SQLALCHEMY_DATABASE_URI. Without replicas every statement uses the primary.
+REPLICA_URIS = [uri.strip() for uri in os.getenv('SQLALCHEMY_REPLICA_URIS', '').split(',') if uri.strip()]
+# Seconds after a user's write during which the reads of that user still go to the primary, so replication lag never
+# hides the user's own changes.
+READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', 10))
+READ_YOUR_WRITES_USERS = 100000
+# Set to a redis:// URL to share the write markers between worker processes, so a write handled by one process keeps
+# the next reads of the user on the primary in every process. They are kept in process memory otherwise.
+READ_YOUR_WRITES_URL = os.getenv('READ_YOUR_WRITES_URL')
+
+_replica = contextvars.ContextVar('replica', default=None)
+
+
+def replica_binds(uris=REPLICA_URIS):
+    # Returns the SQLALCHEMY_BINDS entries of the replicas.
+    return {f'replica_{i}': uri for i, uri in enumerate(uris)}
+
+
+class RoutingSession(Session):
+    # This is a session class which sends the statements of a ReplicaRouter.read method to the replica chosen for it.
+    # Everything else, including every flush, uses the primary.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        key = _replica.get()
+        if key is not None and bind is None and not self._flushing:
+            return self._db.engines[key]
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+class ReplicaRouter:
+    # This is a class that routes the read methods of the services to the healthy replicas in turn and pins the
+    # write methods to the primary. The replicas are checked with 'SELECT 1' at most every check_interval seconds,
+    # and a replica failing a read is left out until the next successful check while the read is retried on the
+    # primary. The check runs on a background thread, so a replica which does not answer never stalls a request.
+    def __init__(self, window=READ_YOUR_WRITES_WINDOW, check_interval=REPLICA_CHECK_INTERVAL,
+                 url=READ_YOUR_WRITES_URL):
+        self.db = None
+        self.keys = []
+        self.healthy = set()
+        self.check_interval = check_interval
+        self.recent_writes = create_cache_backend(url, window, READ_YOUR_WRITES_USERS)
+        self._turn = itertools.count()
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, db, keys):
+        # Sets the Flask-SQLAlchemy extension and the bind keys of the replicas.
+        self.db = db
+        self.keys = list(keys)
+        self.healthy = set(self.keys)
+
+    def read(self, func):
+        # Decorates a service method which only reads. Its first argument is the user, whose recent writes keep the
+        # method on the primary.
+        @wraps(func)
+        def wrapper(user, *args, **kwargs):
+            key = self.choose(user)
+            metrics.db_reads.inc(key or 'primary')
+            if key is None:
+                return func(user, *args, **kwargs)
+            token = _replica.set(key)
+            try:
+                return func(user, *args, **kwargs)
+            except OperationalError:
+                self.healthy.discard(key)
+                self.db.session.rollback()
+            finally:
+                _replica.reset(token)
+            metrics.db_reads.inc('primary')
+            return func(user, *args, **kwargs)
+        return wrapper
+
+    def write(self, func):
+        # Decorates a service method which writes. Its first argument is the user, whose reads go to the primary for
+        # the read-your-writes window afterwards.
+        @wraps(func)
+        def wrapper(user, *args, **kwargs):
+            user_id = user.id if user else None
+            try:
+                return func(user, *args, **kwargs)
+            finally:
+                if user_id is not None and self.keys:
+                    self.recent_writes.set(f'writes:{user_id}', True)
+        return wrapper
+
+    def choose(self, user):
+        # Returns the bind key of the replica for a read of the user, or None for the primary.
+        if not self.keys or not user or self.recent_writes.get(f'writes:{user.id}'):
+            return None
+        self._check()
+        healthy = [key for key in self.keys if key in self.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._turn) % len(healthy)]
+
+    @staticmethod
+    def on_primary():
+        # Returns whether the statements of the current read run on the primary, e.g. so that only data read from the
+        # primary is cached.
+        return _replica.get() is None
+
+    def stats(self):
+        # Returns the replicas and whether they passed the last check.
+        return {key: key in self.healthy for key in self.keys}
+
+    def _check(self):
+        # Starts a check of the replicas on a background thread when the check interval has passed. Only one check
+        # runs at a time, and reads go on with the current state meanwhile.
+        now = time.monotonic()
+        if now < self._next_check or not self._lock.acquire(blocking=False):
+            return
+        self._next_check = now + self.check_interval
+        # The engines are looked up here, as the thread runs outside of the app context.
+        engines = {key: self.db.engines[key] for key in self.keys}
+        try:
+            threading.Thread(target=self._probe, args=(engines,), name='tg-replica-check', daemon=True).start()
+        except RuntimeError:
+            self._lock.release()
+
+    def _probe(self, engines):
+        # Runs 'SELECT 1' on every replica and keeps those which answered as the healthy replicas.
+        try:
+            healthy = set()
+            for key, engine in engines.items():
+                try:
+                    with engine.connect() as connection:
+                        connection.execute(text('SELECT 1'))
+                    healthy.add(key)
+                except DBAPIError:
+                    pass
+            self.healthy = healthy
+        finally:
+            self._lock.release()
+
+
+router = ReplicaRouter()
@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from sqlalchemy.exc import IntegrityError
+
+from tg_bot import app, db
+from . import metrics
+from .models import ScheduledRun, WeatherSubscription
+from .sender import sender
+from .services import WeatherService, WeatherServiceException
+
+# Seconds between two checks of the subscribed locations. 0 disables the rain alerts.
+WEATHER_ALERTS_INTERVAL = int(os.getenv('WEATHER_ALERTS_INTERVAL', 600))
+# Weather requests made at the same time during a tick.
+WEATHER_ALERTS_CONCURRENCY = int(os.getenv('WEATHER_ALERTS_CONCURRENCY', 8))
+
+logger = logging.getLogger(__name__)
+
+
+class WeatherAlertScheduler:
+    # This is a class that checks the weather of every subscribed location on a background thread and alerts the
+    # subscribers when rain starts or stops. Subscriptions are grouped by their cell of the weather grid, so every tick
+    # makes one weather request per distinct location, however many users subscribed to it. Every process may run
+    # the scheduler: a tick is claimed with a row in the scheduled_runs table, so only one process runs it.
+    JOB = 'weather_alerts'
+    KEEP_SLOTS = 100
+
+    def __init__(self, app, interval=WEATHER_ALERTS_INTERVAL, concurrency=WEATHER_ALERTS_CONCURRENCY):
+        self.app = app
+        self.interval = interval
+        self.concurrency = concurrency
+        self.last_run = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Starts the scheduler thread, unless the alerts are disabled or it is already running.
+        with self._lock:
+            if self.interval <= 0 or self._thread:
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='tg-weather-alerts', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        self._stopped.set()
+        if thread:
+            thread.join(timeout)
+
+    def run_once(self, slot=None):
+        # Runs one tick in the current app context and returns its statistics, or None if another process has already
+        # claimed the tick.
+        slot = int(time.time() // self.interval) if slot is None else slot
+        if not self._claim(slot):
+            return None
+        start = time.perf_counter()
+        subscriptions = db.session.query(WeatherSubscription.id, WeatherSubscription.user_id,
+                                         WeatherSubscription.city_name, WeatherSubscription.latitude,
+                                         WeatherSubscription.longitude, WeatherSubscription.is_raining).all()
+        locations = {}
+        for subscription in subscriptions:
+            key = (round(subscription.latitude, WeatherService.WEATHER_GRID_PRECISION),
+                   round(subscription.longitude, WeatherService.WEATHER_GRID_PRECISION))
+            locations.setdefault(key, []).append(subscription)
+        alerts = failed = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            weather = executor.map(self._fetch_raining, locations)
+        for group, raining in zip(locations.values(), weather):
+            if raining is None:
+                failed += 1
+                continue
+            changed = [subscription for subscription in group if subscription.is_raining != raining]
+            if not changed:
+                continue
+            for subscription in changed:
+                text = f'It started raining in {subscription.city_name}. Take an umbrella!' if raining \
+                    else f'The rain in {subscription.city_name} has stopped.'
+                sender.submit('sendMessage', {'chat_id': subscription.user_id, 'text': text})
+            metrics.weather_alerts.inc('rain' if raining else 'no_rain', amount=len(changed))
+            alerts += len(changed)
+            changed_ids = [subscription.id for subscription in changed]
+            WeatherSubscription.query.filter(WeatherSubscription.id.in_(changed_ids)) \
+                .update({'is_raining': raining}, synchronize_session=False)
+            db.session.commit()
+        self.last_run = {
+            'slot': slot,
+            'subscriptions': len(subscriptions),
+            'locations': len(locations),
+            'failed_locations': failed,
+            'alerts': alerts,
+            'seconds': round(time.perf_counter() - start, 3),
+        }
+        return self.last_run
+
+    def stats(self):
+        # Returns the interval and the statistics of the last tick run by this process.
+        return {
+            'interval': self.interval,
+            'running': self._thread is not None,
+            'last_run': self.last_run,
+        }
+
+    @staticmethod
+    def _fetch_raining(location):
+        # Returns whether it is raining at the (latitude, longitude) location, or None if the weather is unavailable.
+        try:
+            return WeatherService.is_raining(WeatherService.get_current_weather_by_geo_data(*location))
+        except (WeatherServiceException, requests.RequestException, ValueError):
+            logger.warning('Cannot get the weather at %s, %s', *location)
+            return None
+
+    def _claim(self, slot):
+        # Inserts the row of the tick. It returns False if another process inserted it first.
+        try:
+            db.session.add(ScheduledRun(job=self.JOB, slot=slot))
+            ScheduledRun.query.filter(ScheduledRun.job == self.JOB, ScheduledRun.slot < slot - self.KEEP_SLOTS) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+            return False
+
+    def _run(self):
+        # Runs a tick at the start of every interval until the scheduler is stopped.
+        while not self._stopped.wait(self.interval - time.time() % self.interval):
+            with self.app.app_context():
+                try:
+                    self.run_once()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Weather alerts tick failed')
+
+
+weather_alerts = WeatherAlertScheduler(app)
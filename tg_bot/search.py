@@ -0,0 +1,192 @@
+import os
+import re
+import threading
+from bisect import bisect_left, insort
+
+from .cache import TTLCache
+
+SEARCH_INDEX_USERS = int(os.getenv('SEARCH_INDEX_USERS', 1024))
+SEARCH_INDEX_TTL = int(os.getenv('SEARCH_INDEX_TTL', 3600))
+SEARCH_FUZZY_CANDIDATES = 50
+
+
+def normalize(term):
+    # Returns the form of a name or phone number which is stored in the index.
+    return term.strip().lower()
+
+
+def trigrams(term):
+    # Returns the trigrams of a term, padded so that short terms and word starts have trigrams too.
+    padded = f'  {term} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    # Returns the edit distance between a and b, counting a swap of two adjacent characters as one edit, or limit + 1
+    # as soon as it is known to exceed the limit.
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before_previous = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                distance = min(distance, before_previous[j - 2] + 1)
+            current.append(distance)
+        if min(current) > limit:
+            return limit + 1
+        before_previous, previous = previous, current
+    return previous[-1]
+
+
+def prefix_distance(word, term, limit):
+    # Returns the smallest edit distance between the word and a prefix of the term of about the same length.
+    return min(edit_distance(word, term[:length], limit)
+               for length in range(max(len(word) - limit, 1), len(word) + limit + 1))
+
+
+class ContactIndex:
+    # This is a class that indexes the contacts of one user. The first names, last names and phone numbers are kept
+    # in a sorted list for prefix matches, and the names in a trigram index for typo-tolerant matches. The version is
+    # the contacts_version of the user the index reflects, and the lock guards the index against concurrent use.
+    def __init__(self, rows=(), version=None):
+        self.contacts = {}
+        self.terms = []
+        self.trigrams = {}
+        self.version = version
+        self.lock = threading.Lock()
+        # The terms of all rows are sorted once, as inserting them one by one into the sorted list is quadratic.
+        for row in rows:
+            self.terms.extend((term, row[0]) for term in self._index(*row))
+        self.terms.sort()
+
+    def add(self, contact_id, first_name, last_name, phone_number):
+        # Adds a contact to the index, keeping the terms sorted.
+        for term in self._index(contact_id, first_name, last_name, phone_number):
+            insort(self.terms, (term, contact_id))
+
+    def remove(self, contact_id):
+        # Removes a contact from the index.
+        contact = self.contacts.pop(contact_id, None)
+        if contact is None:
+            return
+        first_name, last_name, phone_number = contact
+        for term in self._terms(first_name, last_name, phone_number):
+            position = bisect_left(self.terms, (term, contact_id))
+            if position < len(self.terms) and self.terms[position] == (term, contact_id):
+                del self.terms[position]
+        for name in (normalize(first_name), normalize(last_name)):
+            for trigram in trigrams(name):
+                ids = self.trigrams.get(trigram)
+                if ids:
+                    ids.discard(contact_id)
+                    if not ids:
+                        del self.trigrams[trigram]
+
+    def search(self, query, limit=10):
+        # Returns up to limit (contact ID, first name, last name, phone number) rows matching every word of the
+        # query. Prefix matches rank above typo-tolerant matches.
+        words = [normalize(word) for word in query.split()]
+        scores = None
+        for word in words:
+            word_scores = self._match(word)
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {contact_id: scores[contact_id] + score
+                          for contact_id, score in word_scores.items() if contact_id in scores}
+            if not scores:
+                return []
+        if not scores:
+            return []
+        ranked = sorted(scores, key=lambda contact_id: (-scores[contact_id], self.contacts[contact_id][:2]))
+        return [(contact_id, *self.contacts[contact_id]) for contact_id in ranked[:limit]]
+
+    def _match(self, word):
+        # Returns the IDs of the contacts matching a word with a score of 2 for prefix and 1 for fuzzy matches.
+        scores = {}
+        for term in {word, re.sub(r'\D', '', word)} - {''}:
+            position = bisect_left(self.terms, (term,))
+            while position < len(self.terms) and self.terms[position][0].startswith(term):
+                scores[self.terms[position][1]] = 2
+                position += 1
+        if len(word) < 3:
+            return scores
+        limit = 1 if len(word) < 6 else 2
+        shared = {}
+        for trigram in trigrams(word):
+            for contact_id in self.trigrams.get(trigram, ()):
+                shared[contact_id] = shared.get(contact_id, 0) + 1
+        candidates = sorted((contact_id for contact_id in shared if contact_id not in scores),
+                            key=lambda contact_id: -shared[contact_id])[:SEARCH_FUZZY_CANDIDATES]
+        for contact_id in candidates:
+            first_name, last_name, _ = self.contacts[contact_id]
+            for name in (normalize(first_name), normalize(last_name)):
+                if prefix_distance(word, name, limit) <= limit:
+                    scores[contact_id] = 1
+                    break
+        return scores
+
+    def _index(self, contact_id, first_name, last_name, phone_number):
+        # Stores the contact and its trigrams and returns its terms, which the caller adds to the sorted terms.
+        self.contacts[contact_id] = (first_name, last_name, phone_number)
+        for name in (normalize(first_name), normalize(last_name)):
+            for trigram in trigrams(name):
+                self.trigrams.setdefault(trigram, set()).add(contact_id)
+        return self._terms(first_name, last_name, phone_number)
+
+    @staticmethod
+    def _terms(first_name, last_name, phone_number):
+        # Returns the indexed terms of a contact. A phone number written in groups, e.g. '+38 050 123 45 67', is
+        # indexed from the start of every group, so it is found by its local part too.
+        terms = {normalize(first_name), normalize(last_name)}
+        groups = re.findall(r'\d+', phone_number)
+        for i in range(len(groups)):
+            terms.add(''.join(groups[i:]))
+        return terms
+
+
+class ContactSearch:
+    # This is a class that keeps the contact indexes of the most recently searching users. An index is built from the
+    # database on the first search of a user and kept up to date by add() and remove() afterwards. Every change of the
+    # contacts increments the contacts_version of the user in the database, and an index whose version differs from
+    # the current one is rebuilt, so changes made by other processes are never missed.
+    def __init__(self, max_users=SEARCH_INDEX_USERS, ttl=SEARCH_INDEX_TTL):
+        self.indexes = TTLCache(ttl, max_users)
+
+    def search(self, user_id, version, query, loader, limit=10):
+        # Searches the contacts of a user, whose contacts are at the given version. The loader returns the (contact
+        # ID, first name, last name, phone number) rows of the user and is only called when the user has no index of
+        # that version yet.
+        index = self.indexes.get_or_load(user_id, lambda: ContactIndex(loader(), version))
+        if index.version != version:
+            self.indexes.delete(user_id)
+            index = self.indexes.get_or_load(user_id, lambda: ContactIndex(loader(), version))
+        with index.lock:
+            return index.search(query, limit)
+
+    def add(self, user_id, contact_id, first_name, last_name, phone_number):
+        # Adds a contact to the index of the user, if the user has one, and counts the version the add created.
+        index = self.indexes.get(user_id)
+        if index is not None:
+            with index.lock:
+                index.add(contact_id, first_name, last_name, phone_number)
+                index.version += 1
+
+    def remove(self, user_id, contact_id):
+        # Removes a contact from the index of the user, if the user has one, and counts the version the removal
+        # created.
+        index = self.indexes.get(user_id)
+        if index is not None:
+            with index.lock:
+                index.remove(contact_id)
+                index.version += 1
+
+    def invalidate(self, user_id):
+        # Drops the index of the user, so it is rebuilt from the database on the next search, e.g. after an import.
+        self.indexes.delete(user_id)
+
+
+contact_search = ContactSearch()
@@ -0,0 +1,318 @@
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .instrumentation import measure_http
+
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+TG_BASE_URL = os.getenv('TG_BASE_URL')
+# Files sent to the bot are downloaded from https://api.telegram.org/file/bot<token>/<file_path>.
+TG_FILE_URL = os.getenv('TG_FILE_URL', 'https://api.telegram.org/file/bot')
+
+SENDER_WORKERS = int(os.getenv('SENDER_WORKERS', 4))
+SENDER_POOL_SIZE = int(os.getenv('SENDER_POOL_SIZE', 10))
+SENDER_TIMEOUT = float(os.getenv('SENDER_TIMEOUT', 10))
+
+# Telegram allows about 30 messages per second in total and about one message per second to the same chat, with short
+# bursts. A rate of 0 disables the limit.
+SENDER_GLOBAL_RATE = float(os.getenv('SENDER_GLOBAL_RATE', 30))
+SENDER_CHAT_RATE = float(os.getenv('SENDER_CHAT_RATE', 1))
+SENDER_CHAT_BURST = int(os.getenv('SENDER_CHAT_BURST', 3))
+SENDER_MAX_RETRIES = int(os.getenv('SENDER_MAX_RETRIES', 5))
+
+
+class TokenBucket:
+    # This is a class that allows rate events per second on average, with bursts of up to capacity events. A rate of
+    # 0 allows every event.
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        # Returns the seconds until the next event is allowed, 0 if it is allowed now.
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        # Spends a token on an event.
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def is_full(self, now):
+        if not self.rate:
+            return True
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class _Job:
+    # The calls of one submit, the Future they resolve and the responses received so far.
+    def __init__(self, calls, future, result):
+        self.calls = calls
+        self.future = future
+        self.result = result
+        self.responses = []
+        self.retries = 0
+        self.ready_at = time.monotonic()
+
+
+class _ChatQueue:
+    # The pending jobs of one chat, its rate limit and the time before which nothing may be sent to it.
+    def __init__(self, rate, burst):
+        self.jobs = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.not_before = 0.0
+        self.busy = False
+
+    def is_idle(self, now):
+        # Returns True when the chat has nothing pending and its limit is fully recovered, so it can be forgotten.
+        return not self.jobs and not self.busy and self.not_before <= now and self.bucket.is_full(now)
+
+
+class TelegramSender:
+    # This is a class that delivers Bot API calls over one pooled keep-alive HTTP session. Calls are queued per chat
+    # and sent by background worker threads, so the caller never waits for Telegram. The workers serve the chats in
+    # round-robin order within Telegram's flood limits: a global token bucket and one per chat. A call answered with
+    # 429 is retried after the retry_after Telegram asks for.
+    def __init__(self, base_url, token, file_url=TG_FILE_URL, workers=SENDER_WORKERS, pool_size=SENDER_POOL_SIZE,
+                 timeout=SENDER_TIMEOUT, global_rate=SENDER_GLOBAL_RATE, chat_rate=SENDER_CHAT_RATE,
+                 chat_burst=SENDER_CHAT_BURST, max_retries=SENDER_MAX_RETRIES):
+        self.base_url = base_url
+        self.token = token
+        self.file_url = file_url
+        self.workers = workers
+        self.timeout = timeout
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chats = OrderedDict()
+        self.unfinished = 0
+        self._stopping = False
+        self._threads = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+
+    def start(self):
+        # Starts the worker threads. It is called lazily on the first submit, so importing the module (or forking a
+        # server process) does not spawn threads.
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'tg-sender-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        # Stops the worker threads after the calls already queued have been delivered.
+        with self._lock:
+            threads, self._threads = self._threads, []
+        with self._changed:
+            self._stopping = True
+            self._changed.notify_all()
+        for thread in threads:
+            thread.join(timeout)
+
+    def join(self, timeout=None):
+        # Waits until every queued call has been delivered. It returns False if the timeout expired first.
+        with self._changed:
+            return self._changed.wait_for(lambda: not self.unfinished, timeout)
+
+    def pending(self):
+        # Returns the number of submitted jobs which are not finished yet.
+        return self.unfinished
+
+    def call(self, method, payload, timeout=None, files=None):
+        # Performs a Bot API call synchronously on the pooled session and returns the response. It bypasses the
+        # queue and the rate limits. With files, a dict of requests-style (file name, file object, MIME type) uploads,
+        # the call is sent as multipart/form-data; the file objects are rewound first, so a retried call sends them
+        # again.
+        if files:
+            for _, file, *_ in files.values():
+                file.seek(0)
+            body = {'data': payload, 'files': files}
+        else:
+            body = {'json': payload}
+        with measure_http('bot_api') as request:
+            response = self.session.post(f'{self.base_url}{self.token}/{method}', timeout=timeout or self.timeout,
+                                         **body)
+            request['status'] = response.status_code
+        return response
+
+    def download(self, file_id):
+        # Resolves a file sent to the bot with getFile and returns the streamed response of its download, so the
+        # content can be read piece by piece. Use the response as a context manager to release the connection.
+        response = self.call('getFile', {'file_id': file_id})
+        response.raise_for_status()
+        file_path = response.json()['result']['file_path']
+        with measure_http('bot_api') as request:
+            download = self.session.get(f'{self.file_url}{self.token}/{file_path}', stream=True, timeout=self.timeout)
+            request['status'] = download.status_code
+        download.raise_for_status()
+        return download
+
+    def submit(self, method, payload, callback=None, files=None):
+        # Queues a Bot API call for the chat of its payload and returns a Future which resolves to the response. The
+        # optional callback is called with that Future once the call is finished. Files are uploaded as in call().
+        return self._enqueue([(method, payload, files)], callback, lambda responses: responses[0])
+
+    def submit_sequence(self, calls, callback=None):
+        # Queues several (method, payload) Bot API calls as one job, so they are sent one after another and arrive in
+        # order. It returns a Future which resolves to the list of responses.
+        return self._enqueue([(method, payload, None) for method, payload in calls], callback,
+                             lambda responses: responses)
+
+    def _enqueue(self, calls, callback, result):
+        self.start()
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        chat_id = calls[0][1].get('chat_id')
+        with self._changed:
+            chat = self._chat(chat_id)
+            chat.jobs.append(_Job(calls, future, result))
+            self.unfinished += 1
+            self._changed.notify()
+        return future
+
+    def take_inline(self, chat_id):
+        # Spends the tokens of one call made outside the sender, e.g. a reply returned as the webhook response, and
+        # returns True if the flood limits allow it now. Nothing is spent and False is returned when they do not, or
+        # when calls to the chat are still queued, so the caller submits the call instead and the order is kept.
+        with self._changed:
+            now = time.monotonic()
+            chat = self._chat(chat_id)
+            if chat.jobs or chat.busy or max(chat.not_before - now, chat.bucket.delay(now),
+                                             self.global_bucket.delay(now)) > 0:
+                return False
+            self.global_bucket.take(now)
+            chat.bucket.take(now)
+            self.chats.move_to_end(chat_id)
+            # The workers may never run when every reply is inline, so idle chats are forgotten here too.
+            for idle_id, idle in list(self.chats.items())[:-1]:
+                if not idle.is_idle(now):
+                    break
+                del self.chats[idle_id]
+            return True
+
+    def _chat(self, chat_id):
+        # Returns the queue of the chat, creating it if needed. Calls without a chat only count against the global
+        # limit.
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = _ChatQueue(self.chat_rate if chat_id is not None else 0, self.chat_burst)
+        return chat
+
+    def _next_call(self):
+        # Waits for the next job whose chat and the global limit allow a call now, and marks its chat busy. Chats are
+        # tried in round-robin order, so a chat with many queued messages cannot hold back the others. It returns
+        # None once the sender is stopped and nothing is left to deliver.
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                global_delay = self.global_bucket.delay(now)
+                wait = None
+                for chat_id, chat in list(self.chats.items()):
+                    if chat.busy:
+                        continue
+                    if not chat.jobs:
+                        if chat.is_idle(now):
+                            del self.chats[chat_id]
+                        continue
+                    delay = max(chat.not_before - now, chat.bucket.delay(now), global_delay)
+                    if delay <= 0:
+                        self.global_bucket.take(now)
+                        chat.bucket.take(now)
+                        chat.busy = True
+                        self.chats.move_to_end(chat_id)
+                        job = chat.jobs.popleft()
+                        metrics.sender_wait.observe(now - job.ready_at)
+                        return chat_id, job
+                    wait = delay if wait is None else min(wait, delay)
+                if self._stopping and not self.unfinished:
+                    return None
+                self._changed.wait(wait)
+
+    def _requeue(self, chat_id, job, delay=0.0):
+        # Puts a job with calls left back at the front of its chat's queue, optionally not before delay seconds.
+        with self._changed:
+            now = time.monotonic()
+            chat = self.chats[chat_id]
+            chat.busy = False
+            chat.not_before = max(chat.not_before, now + delay)
+            job.ready_at = now
+            chat.jobs.appendleft(job)
+            self._changed.notify_all()
+
+    def _finish(self, chat_id):
+        with self._changed:
+            self.chats[chat_id].busy = False
+            self.unfinished -= 1
+            self._changed.notify_all()
+
+    @staticmethod
+    def _retry_after(response):
+        # Returns the seconds Telegram asks to wait before retrying a call answered with 429, or None for any other
+        # response.
+        if response.status_code != 429:
+            return None
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return 1.0
+
+    def _worker(self):
+        # Sends one call at a time until the sender is stopped. A job with several calls is put back after each call,
+        # so the limit of its chat applies to every message.
+        while True:
+            picked = self._next_call()
+            if picked is None:
+                return
+            chat_id, job = picked
+            method, payload, files = job.calls[len(job.responses)]
+            try:
+                response = self.call(method, payload, files=files)
+            except Exception as e:
+                self._finish(chat_id)
+                if job.future.set_running_or_notify_cancel():
+                    job.future.set_exception(e)
+                continue
+            retry_after = self._retry_after(response)
+            if retry_after is not None and job.retries < self.max_retries:
+                job.retries += 1
+                metrics.sender_retries.inc()
+                self._requeue(chat_id, job, retry_after)
+                continue
+            job.responses.append(response)
+            if len(job.responses) < len(job.calls):
+                self._requeue(chat_id, job)
+                continue
+            self._finish(chat_id)
+            if job.future.set_running_or_notify_cancel():
+                job.future.set_result(job.result(job.responses))
+
+
+sender = TelegramSender(TG_BASE_URL, BOT_TOKEN, TG_FILE_URL)
+atexit.register(sender.stop)
@@ -1,10 +1,22 @@
+import csv
 import os
-from dotenv import load_dotenv
+import re
+import secrets
+import tempfile
+from collections import namedtuple
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import requests
+from sqlalchemy import and_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 
-from tg_bot.models import ShopList, Item, db, User, ContactBook
-
-load_dotenv()
+from tg_bot import contact_files
+from tg_bot.cache import TTLCache, create_cache_backend
+from tg_bot.instrumentation import measure_http
+from tg_bot.models import ShopList, Item, db, User, ContactBook, WeatherSubscription
+from tg_bot.routing import router
+from tg_bot.search import contact_search
 
 
 class WeatherServiceException(Exception):
@@ -19,39 +31,127 @@ class ShopWizardException(Exception):
     pass
 
 
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 20))
+
+Page = namedtuple('Page', ['rows', 'has_previous', 'has_next'])
+
+
+def keyset_page(query, id_column, after_id=None, before_id=None, size=PAGE_SIZE):
+    # Returns one page of the query ordered by id_column: the page after the row with after_id, the page before the
+    # row with before_id, or the first page. Only size + 1 rows are fetched, whatever the size of the table.
+    condition, order = keyset_clauses(id_column, after_id, before_id)
+    if condition is not None:
+        query = query.filter(condition)
+    rows = query.order_by(order).limit(size + 1).all()
+    return rows_page([tuple(row) for row in rows], after_id, before_id, size)
+
+
+def keyset_clauses(id_column, after_id=None, before_id=None):
+    # Returns the condition selecting the rows of a page (None for the first page) and the order to fetch them in.
+    if before_id is not None:
+        return id_column < before_id, id_column.desc()
+    if after_id is not None:
+        return id_column > after_id, id_column
+    return None, id_column
+
+
+def rows_page(rows, after_id=None, before_id=None, size=PAGE_SIZE):
+    # Returns the page of up to size + 1 rows fetched in the order given by keyset_clauses().
+    if before_id is not None:
+        return Page(list(reversed(rows[:size])), len(rows) > size, True)
+    return Page(rows[:size], after_id is not None, len(rows) > size)
+
+
 class WeatherService:
     # This is a class that provides weather-related functionality.
     GEO_URL = os.getenv('GEO_URL')
     WEATHER_URL = os.getenv('WEATHER_URL')
+    # Both APIs are called over one keep-alive session, so a worker reuses its connections after the warm-up.
+    session = requests.Session()
+    # Seconds to wait for connecting to and for reading from the APIs, so a request that never answers cannot hold a
+    # webhook thread or the rain alert scheduler forever.
+    WEATHER_TIMEOUT = float(os.getenv('WEATHER_TIMEOUT', 10))
+
+    # Geocoding results rarely change, so they are cached for long; the current weather is cached for a short time
+    # per cell of a coordinate grid, so users choosing the same city share one upstream request.
+    WEATHER_GRID_PRECISION = int(os.getenv('WEATHER_GRID_PRECISION', 2))
+    geo_cache = TTLCache(ttl=int(os.getenv('GEO_CACHE_TTL', 86400)),
+                         max_size=int(os.getenv('GEO_CACHE_SIZE', 4096)))
+    weather_cache = TTLCache(ttl=int(os.getenv('WEATHER_CACHE_TTL', 60)),
+                             max_size=int(os.getenv('WEATHER_CACHE_SIZE', 4096)))
 
     @staticmethod
     def get_geo_data(city_name):
         # This static method retrieves geographic data for a given city name by making a request to the specified
-        # GEO_URL. It returns the JSON response containing the geo data.
+        # GEO_URL. It returns the JSON response containing the geo data. Results are cached by normalized city name.
+        key = ' '.join(city_name.lower().split())
+        return WeatherService._load(WeatherService.geo_cache, key, lambda: WeatherService._fetch_geo_data(city_name))
+
+    @staticmethod
+    def _fetch_geo_data(city_name):
         params = {
             'name': city_name
         }
-        res = requests.get(f'{WeatherService.GEO_URL}', params=params)
+        try:
+            with measure_http('geo') as request:
+                res = WeatherService.session.get(f'{WeatherService.GEO_URL}', params=params,
+                                                 timeout=WeatherService.WEATHER_TIMEOUT)
+                request['status'] = res.status_code
+        except requests.RequestException:
+            raise WeatherServiceException('Cannot get geo data')
         if res.status_code != 200:
             raise WeatherServiceException('Cannot get geo data')
-        elif not res.json().get('results'):
+        results = res.json().get('results')
+        if not results:
             raise WeatherServiceException('City not found')
-        return res.json().get('results')
+        return results
 
     @staticmethod
     def get_current_weather_by_geo_data(lat, lon):
         # This static method retrieves the current weather data for a given latitude and longitude by making a request
-        # to the specified WEATHER_URL. It returns the JSON response containing the current weather data.
+        # to the specified WEATHER_URL. It returns the JSON response containing the current weather data. Results are
+        # cached by coordinates rounded to the weather grid.
+        key = (round(float(lat), WeatherService.WEATHER_GRID_PRECISION),
+               round(float(lon), WeatherService.WEATHER_GRID_PRECISION))
+        return WeatherService._load(WeatherService.weather_cache, key,
+                                    lambda: WeatherService._fetch_current_weather(*key))
+
+    @staticmethod
+    def _load(cache, key, loader):
+        # Returns the cached value for the key, loading it on a miss. A request which finds the same key being loaded
+        # by another thread waits at most as long as that load may take to connect and to read, so one hung upstream
+        # request cannot hold every thread asking for the same city.
+        try:
+            return cache.get_or_load(key, loader, 2 * WeatherService.WEATHER_TIMEOUT)
+        except FutureTimeoutError:
+            raise WeatherServiceException('The weather service is not responding. Please try again later.')
+
+    @staticmethod
+    def _fetch_current_weather(lat, lon):
         params = {
             'latitude': lat,
             'longitude': lon,
             'current_weather': True
         }
-        res = requests.get(f'{WeatherService.WEATHER_URL}', params=params)
+        try:
+            with measure_http('weather') as request:
+                res = WeatherService.session.get(f'{WeatherService.WEATHER_URL}', params=params,
+                                                 timeout=WeatherService.WEATHER_TIMEOUT)
+                request['status'] = res.status_code
+        except requests.RequestException:
+            raise WeatherServiceException('Cannot get weather data')
         if res.status_code != 200:
             raise WeatherServiceException('Cannot get geo data')
         return res.json().get('current_weather')
 
+    @staticmethod
+    def cache_stats():
+        # This static method returns the hit and miss statistics of the geocoding and weather caches.
+        return {
+            'geo': WeatherService.geo_cache.stats(),
+            'weather': WeatherService.weather_cache.stats(),
+        }
+
     @staticmethod
     def get_rain_status(city_name):
         # This static method retrieves the rain status for a given city name. It uses the get_geo_data() and
@@ -65,191 +165,553 @@ class WeatherService:
         rain_status = weather.get('rain', 'No rain')
         return rain_status
 
+    @staticmethod
+    def is_raining(weather):
+        # This static method tells whether the current weather returned by get_current_weather_by_geo_data() is
+        # rainy, by the amount of rain or else by the WMO weather code (drizzle, rain, showers and thunderstorms).
+        rain = weather.get('rain')
+        if rain is not None:
+            return rain > 0
+        code = weather.get('weathercode')
+        return code is not None and (51 <= code <= 67 or 80 <= code <= 82 or code >= 95)
+
+    @staticmethod
+    @router.write
+    def subscribe(user, city_name):
+        # This static method subscribes the given user to rain alerts for a city. The city is resolved to coordinates
+        # once here, so the alert scheduler never has to geocode. It returns the name of the city as found.
+        if user:
+            geo_data = WeatherService.get_geo_data(city_name)
+            city = geo_data[0]
+            subscription = WeatherSubscription(user_id=user.id, city_name=city['name'], latitude=city['latitude'],
+                                               longitude=city['longitude'])
+            db.session.add(subscription)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                raise WeatherServiceException(f'You are already subscribed to rain alerts for {city["name"]}.')
+            return city['name']
+        else:
+            raise WeatherServiceException('User not found.')
+
+    @staticmethod
+    @router.write
+    def unsubscribe(user, city_name=None):
+        # This static method removes the rain alert subscription of the given user for a city, or all of them without a
+        # city name. It returns the number of removed subscriptions.
+        if user:
+            query = WeatherSubscription.query.filter(WeatherSubscription.user_id == user.id)
+            if city_name:
+                query = query.filter(db.func.lower(WeatherSubscription.city_name) == city_name.lower())
+            count = query.delete(synchronize_session=False)
+            db.session.commit()
+            if not count:
+                raise WeatherServiceException('No matching rain alert subscription found.')
+            return count
+        else:
+            raise WeatherServiceException('User not found.')
+
+
+class UserService:
+    # This is a class that resolves the user who sent an update.
+    PROFILE_FIELDS = ('first_name', 'last_name', 'username', 'language_code')
+
+    @staticmethod
+    def get_or_create_user(data):
+        # This static method returns the user for the 'from' payload of an update with one primary key lookup. New
+        # users are inserted with an upsert where the database supports it, and the profile fields of existing users
+        # are only written when they changed.
+        user = User.query.get(data['id'])
+        if user:
+            changed = False
+            for field in UserService.PROFILE_FIELDS:
+                value = data.get(field)
+                if value is not None and getattr(user, field) != value:
+                    setattr(user, field, value)
+                    changed = True
+            if changed:
+                db.session.commit()
+            return user
+        values = {field: data.get(field) for field in UserService.PROFILE_FIELDS}
+        values['is_bot'] = data.get('is_bot', False)
+        dialect = db.engine.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+            db.session.execute(insert(User.__table__).values(id=data['id'], **values)
+                               .on_conflict_do_nothing(index_elements=['id']))
+            db.session.commit()
+            return User.query.get(data['id'])
+        user = User(id=data['id'], **values)
+        db.session.add(user)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            user = User.query.get(data['id'])
+        return user
+
 
 class ShopWizardService:
     # This is a class that provides functionality related to a shopping list.
+
+    # The item names of every (user, list) pair are cached for /show_items under a version of the list. Every write
+    # path moves the list it changes to a new version, see invalidate_items(). LIST_CACHE_URL selects a shared Redis
+    # store instead of the in-process LRU.
+    items_cache = create_cache_backend(os.getenv('LIST_CACHE_URL'),
+                                       ttl=int(os.getenv('LIST_CACHE_TTL', 300)),
+                                       max_size=int(os.getenv('LIST_CACHE_SIZE', 4096)))
+
+    @staticmethod
+    def items_cache_key(user, list_name):
+        # This static method returns the key of the cached item names of a shop list at its current version. The key
+        # must be taken before the list is read, so a page read before a change is stored under the old version.
+        version = ShopWizardService.items_cache.get(f'items_version:{user.id}:{list_name}') or 0
+        return f'items:{user.id}:{list_name}:{version}'
+
+    @staticmethod
+    def invalidate_items(user, *list_names):
+        # This static method invalidates the cached item names of shop lists after a change has been committed. Every
+        # list moves to a new version, so a page read before the change which is cached after this call is never
+        # served; the entry of the previous version is deleted.
+        for list_name in list_names:
+            key = ShopWizardService.items_cache_key(user, list_name)
+            ShopWizardService.items_cache.set(f'items_version:{user.id}:{list_name}', secrets.token_hex(8))
+            ShopWizardService.items_cache.delete(key)
+
+    @staticmethod
+    def change_item_count(list_id, delta):
+        # This static method adds delta to the item count of the shop list with the given ID. The update is an
+        # increment in SQL, so it joins the transaction of the caller and concurrent changes never overwrite each other.
+        ShopList.query.filter_by(id=list_id) \
+            .update({ShopList.item_count: ShopList.item_count + delta}, synchronize_session=False)
+
     @staticmethod
-    def create_shop_list(user_id, list_name):
-        # This static method creates a new shop list for a user with the specified user ID and list name. It adds the
-        # shop list to the database.
-        user = User.query.get(user_id)
+    @router.write
+    def create_shop_list(user, list_name):
+        # This static method creates a new shop list for the given user and list name. It adds the
+        # shop list to the database. A list with the same name is detected by the unique constraint.
         if user:
-            shop_list = ShopList(user_id=user_id, list_name=list_name)
+            shop_list = ShopList(user_id=user.id, list_name=list_name)
             db.session.add(shop_list)
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                raise ShopWizardException(f'Shop list "{list_name}" already exists. Please try other name')
         else:
-            raise ShopWizardException(f'User with ID {user_id} not found.')
+            raise ShopWizardException('User not found.')
 
     @staticmethod
-    def remove_shop_list(user_id, list_name):
-        # This static method removes a shop list with the specified user ID and list name. It deletes the shop list
-        # from the database.
-        user = User.query.get(user_id)
+    @router.write
+    def remove_shop_list(user, list_name):
+        # This static method removes a shop list of the given user and list name together with its items. The
+        # items and the list are deleted with set-based statements in one transaction. It returns the number of
+        # deleted items.
         if user:
-            shop_list = ShopList.query.filter_by(user_id=user_id, list_name=list_name).first()
+            shop_list = ShopList.query.filter_by(user_id=user.id, list_name=list_name).first()
             if shop_list:
-                db.session.delete(shop_list)
+                items_count = Item.query.filter_by(list_id=shop_list.id).delete(synchronize_session=False)
+                ShopList.query.filter_by(id=shop_list.id).delete(synchronize_session=False)
                 db.session.commit()
+                ShopWizardService.invalidate_items(user, list_name)
+                return items_count
             else:
                 raise ShopWizardException(f'Shop list "{list_name}" not found. Please try other name')
         else:
-            raise ShopWizardException(f'User with ID {user_id} not found.')
+            raise ShopWizardException('User not found.')
 
     @staticmethod
-    def edit_shop_list(user_id, old_list_name, new_list_name):
-        # This static method edits the name of a shop list with the specified user ID and old list name. It updates the
+    @router.write
+    def edit_shop_list(user, old_list_name, new_list_name):
+        # This static method edits the name of a shop list of the given user and old list name. It updates the
         # shop list name in the database.
-        user = User.query.get(user_id)
         if user:
-            shop_list = ShopList.query.filter_by(user_id=user_id, list_name=old_list_name).first()
+            shop_list = ShopList.query.filter_by(user_id=user.id, list_name=old_list_name).first()
             if shop_list:
                 shop_list.list_name = new_list_name
-                db.session.commit()
+                try:
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+                    raise ShopWizardException(f'Shop list "{new_list_name}" already exists. Please try other name')
+                ShopWizardService.invalidate_items(user, old_list_name, new_list_name)
             else:
                 raise ShopWizardException(f'Shop list "{old_list_name}" not found. Please try other name')
         else:
-            raise ShopWizardException(f'User with ID {user_id} not found.')
+            raise ShopWizardException('User not found.')
 
     @staticmethod
-    def add_item_to_list(user_id, list_name, item):
-        # This static method adds an item to a shop list with the specified user ID and list name. It creates a new
+    def add_item_to_list(user, list_name, item):
+        # This static method adds an item to a shop list of the given user and list name. It creates a new
         # item and associates it with the shop list in the database.
-        user = User.query.get(user_id)
+        ShopWizardService.add_items_to_list(user, list_name, [item])
+
+    @staticmethod
+    @router.write
+    def add_items_to_list(user, list_name, items):
+        # This static method adds several items to a shop list of the given user and list name. The list is
+        # resolved once and all items are inserted with one bulk statement and one commit, which also updates the item
+        # count of the list. It returns the added item names.
+        names = [item.strip() for item in items if item.strip()]
+        if not names:
+            raise ShopWizardException('Please provide at least one item name.')
         if user:
-            shop_list = ShopList.query.filter_by(user_id=user_id, list_name=list_name).first()
+            shop_list = ShopList.query.filter_by(user_id=user.id, list_name=list_name).first()
             if shop_list:
-                new_item = Item(name=item, list=shop_list)
-                db.session.add(new_item)
+                db.session.execute(Item.__table__.insert(), [{'name': name, 'list_id': shop_list.id} for name in names])
+                ShopWizardService.change_item_count(shop_list.id, len(names))
                 db.session.commit()
+                ShopWizardService.invalidate_items(user, list_name)
+                return names
             else:
                 raise ShopWizardException(f'Shop list "{list_name}" not found. Please try other name')
         else:
-            raise ShopWizardException(f'User with ID {user_id} not found.')
+            raise ShopWizardException('User not found.')
 
     @staticmethod
-    def show_list_items(user_id, list_name):
-        # This static method retrieves the items in a shop list with the specified user ID and list name. It returns
-        # a list of item names.
-        user = User.query.get(user_id)
+    @router.read
+    def shop_lists(user):
+        # This static method retrieves the shop lists of the given user. It returns (list name, item count) rows
+        # ordered by name, read from the shop lists alone without touching the items.
         if user:
-            shop_list = ShopList.query.filter_by(user_id=user_id, list_name=list_name).first()
-            if shop_list:
-                items = Item.query.filter_by(list=shop_list).all()
-                return [item.name for item in items]
+            return db.session.query(ShopList.list_name, ShopList.item_count) \
+                .filter(ShopList.user_id == user.id).order_by(ShopList.list_name).all()
+        else:
+            raise ShopWizardException('User not found.')
+
+    @staticmethod
+    @router.read
+    def show_list_items(user, list_name, after_id=None, before_id=None):
+        # This static method retrieves the items in a shop list of the given user and list name. It returns the ID of
+        # the list and one page of (item ID, item name) rows. The first page is read from the items cache when the
+        # list was shown before.
+        if user:
+            first_page = after_id is None and before_id is None
+            key = ShopWizardService.items_cache_key(user, list_name)
+            if first_page:
+                cached = ShopWizardService.items_cache.get(key)
+                if cached is not None:
+                    return cached['list_id'], Page([tuple(row) for row in cached['rows']], False, cached['has_next'])
+            found = ShopWizardService.list_items_page(user, ShopList.list_name == list_name, after_id, before_id)
+            if found:
+                list_id, _, page = found
+                # A page read from a replica may lag behind the list, so only pages read from the primary are cached.
+                if first_page and router.on_primary():
+                    ShopWizardService.items_cache.set(key, {'list_id': list_id, 'rows': page.rows,
+                                                            'has_next': page.has_next})
+                return list_id, page
             else:
                 raise ShopWizardException(f'Shop list "{list_name}" not found. Please try other name.')
         else:
-            raise ShopWizardException(f'User with ID {user_id} not found.')
+            raise ShopWizardException('User not found.')
 
     @staticmethod
-    def remove_item_from_list(user_id, list_name, item):
-        # This static method removes an item from a shop list with the specified user ID, list name, and item name.
+    @router.read
+    def show_list_items_by_id(user, list_id, after_id=None, before_id=None):
+        # This static method retrieves a page of the items in the shop list with the given ID, which must belong to the
+        # given user. It returns the name of the list and the page.
+        if user:
+            found = ShopWizardService.list_items_page(user, ShopList.id == list_id, after_id, before_id)
+            if found:
+                return found[1], found[2]
+            else:
+                raise ShopWizardException('Shop list not found. Please show it again.')
+        else:
+            raise ShopWizardException('User not found.')
+
+    @staticmethod
+    def list_items_page(user, criterion, after_id=None, before_id=None):
+        # This static method resolves the shop list of the given user matching the criterion and reads a page of its
+        # (item ID, item name) rows in one query: the list is outer joined to the items of the page, so a list
+        # without items still yields one row. Only the needed columns are selected, as plain tuples instead of ORM
+        # objects. It returns the list ID, the list name and the page, or None if there is no such list.
+        condition, order = keyset_clauses(Item.id, after_id, before_id)
+        join = Item.list_id == ShopList.id if condition is None else and_(Item.list_id == ShopList.id, condition)
+        rows = db.session.query(ShopList.id, ShopList.list_name, Item.id, Item.name).outerjoin(Item, join) \
+            .filter(ShopList.user_id == user.id, criterion).order_by(order).limit(PAGE_SIZE + 1).all()
+        if not rows:
+            return None
+        items = [(item_id, name) for _, _, item_id, name in rows if item_id is not None]
+        return rows[0][0], rows[0][1], rows_page(items, after_id, before_id)
+
+    @staticmethod
+    @router.write
+    def remove_item_from_list(user, list_name, item):
+        # This static method removes an item from a shop list of the given user, list name, and item name.
         # It deletes the item from the database.
-        user = User.query.get(user_id)
         if user:
-            shop_list = ShopList.query.filter_by(user_id=user_id, list_name=list_name).first()
+            shop_list = ShopList.query.filter_by(user_id=user.id, list_name=list_name).first()
             if shop_list:
                 item_to_remove = Item.query.filter_by(list=shop_list, name=item).first()
                 if item_to_remove:
                     db.session.delete(item_to_remove)
+                    ShopWizardService.change_item_count(shop_list.id, -1)
                     db.session.commit()
+                    ShopWizardService.invalidate_items(user, list_name)
                 else:
                     raise ShopWizardException(f'Item "{item}" not found in the list "{list_name}". '
                                               f'Please try other name')
             else:
                 raise ShopWizardException(f'Shop list "{list_name}" not found. Please try other name')
         else:
-            raise ShopWizardException(f'User with ID {user_id} not found.')
+            raise ShopWizardException('User not found.')
 
     @staticmethod
-    def remove_items_list(user_id, list_name):
-        # This static method removes all items from a shop list with the specified user ID and list name. It deletes
-        # all items associated with the shop list from the database.
-        user = User.query.get(user_id)
+    @router.write
+    def remove_items_from_list(user, list_name, items):
+        # This static method removes several items from a shop list of the given user and list name. The list
+        # is resolved once and one item is deleted for every given name, like remove_item_from_list does, with one
+        # bulk statement and one commit; a name given twice removes two items. It returns the names of the removed
+        # items and the names which were not found in the list, once for every request left unmatched, so a name given
+        # more times than the list holds it is reported for the extra copies.
+        names = [item.strip() for item in items if item.strip()]
+        if not names:
+            raise ShopWizardException('Please provide at least one item name.')
         if user:
-            shop_list = ShopList.query.filter_by(user_id=user_id, list_name=list_name).first()
+            shop_list = ShopList.query.filter_by(user_id=user.id, list_name=list_name).first()
             if shop_list:
-                items_to_remove = Item.query.filter_by(list=shop_list).all()
-                for item in items_to_remove:
-                    db.session.delete(item)
+                candidates = {}
+                for item_id, name in db.session.query(Item.id, Item.name) \
+                        .filter(Item.list_id == shop_list.id, Item.name.in_(set(names))).order_by(Item.id):
+                    candidates.setdefault(name, []).append(item_id)
+                ids, removed, not_found = [], [], []
+                for name in names:
+                    if candidates.get(name):
+                        ids.append(candidates[name].pop(0))
+                        removed.append(name)
+                    else:
+                        not_found.append(name)
+                if not ids:
+                    raise ShopWizardException(f'None of the items were found in the list "{list_name}". '
+                                              f'Please try other names')
+                deleted = Item.query.filter(Item.id.in_(ids)).delete(synchronize_session=False)
+                ShopWizardService.change_item_count(shop_list.id, -deleted)
                 db.session.commit()
+                ShopWizardService.invalidate_items(user, list_name)
+                return removed, not_found
             else:
                 raise ShopWizardException(f'Shop list "{list_name}" not found. Please try other name')
         else:
-            raise ShopWizardException(f'User with ID {user_id} not found.')
+            raise ShopWizardException('User not found.')
+
+    @staticmethod
+    @router.write
+    def remove_items_list(user, list_name):
+        # This static method removes all items from a shop list of the given user and list name. It deletes
+        # all items associated with the shop list with one set-based statement and returns the number of deleted
+        # items.
+        if user:
+            shop_list = ShopList.query.filter_by(user_id=user.id, list_name=list_name).first()
+            if shop_list:
+                list_id = shop_list.id
+                items_count = Item.query.filter_by(list_id=list_id).delete(synchronize_session=False)
+                ShopList.query.filter_by(id=list_id).update({ShopList.item_count: 0}, synchronize_session=False)
+                db.session.commit()
+                ShopWizardService.invalidate_items(user, list_name)
+                ShopWizardService.items_cache.set(ShopWizardService.items_cache_key(user, list_name),
+                                                  {'list_id': list_id, 'rows': [], 'has_next': False})
+                return items_count
+            else:
+                raise ShopWizardException(f'Shop list "{list_name}" not found. Please try other name')
+        else:
+            raise ShopWizardException('User not found.')
 
 
 class ContactBookService:
     # This is a class that provides functionality related to a contact book.
+    CONTACTS_IMPORT_CHUNK_SIZE = int(os.getenv('CONTACTS_IMPORT_CHUNK_SIZE', 1000))
+    CONTACTS_EXPORT_BATCH_SIZE = int(os.getenv('CONTACTS_EXPORT_BATCH_SIZE', 1000))
+    CONTACTS_EXPORT_MEMORY_SIZE = int(os.getenv('CONTACTS_EXPORT_MEMORY_SIZE', 1024 * 1024))
+
     @staticmethod
-    def status(user_id):
-        # This static method retrieves the number of contacts in the contact book for a user with the specified user ID.
-        user = User.query.get(user_id)
+    @router.read
+    def status(user):
+        # This static method retrieves the number of contacts in the contact book for the given user. It reads the
+        # contact count of the user by primary key instead of counting the contacts.
         if user:
-            contact_count = ContactBook.query.filter_by(user_id=user_id).count()
-            return contact_count
+            return db.session.query(User.contact_count).filter(User.id == user.id).scalar() or 0
         else:
-            raise ContactBookException(f'User with ID {user_id} not found.')
+            raise ContactBookException('User not found.')
 
     @staticmethod
-    def list_of_contacts(user_id):
-        # This static method retrieves the list of contacts in the contact book for a user with the specified user ID.
-        # It returns a formatted string listing the contacts.
-        user = User.query.get(user_id)
+    @router.read
+    def list_of_contacts(user, after_id=None, before_id=None):
+        # This static method retrieves the list of contacts in the contact book for the given user one page at a
+        # time. It returns a page of (contact ID, first name, last name) rows.
         if user:
-            contacts = ContactBook.query.filter_by(user_id=user_id).all()
-            contact_list = '\n'.join(
-                [f"{i + 1}. {contact.first_name} {contact.last_name}" for i, contact in enumerate(contacts)])
-            return contact_list
+            query = db.session.query(ContactBook.id, ContactBook.first_name, ContactBook.last_name) \
+                .filter(ContactBook.user_id == user.id)
+            return keyset_page(query, ContactBook.id, after_id, before_id)
         else:
-            raise ContactBookException(f'User with ID {user_id} not found.')
+            raise ContactBookException('User not found.')
 
     @staticmethod
-    def show_contact(user_id, first_name, last_name):
-        # This static method retrieves a specific contact from the contact book for a user with the specified user ID,
-        # first name and last name.
-        user = User.query.get(user_id)
+    @router.read
+    def show_contact(user, first_name, last_name):
+        # This static method retrieves a specific contact from the contact book for the given user,
+        # first name and last name. It returns a (first name, last name, phone number) row with attribute access.
         if user:
-            contact = ContactBook.query.filter_by(user_id=user_id, first_name=first_name, last_name=last_name).first()
+            contact = db.session.query(ContactBook.first_name, ContactBook.last_name, ContactBook.phone_number) \
+                .filter_by(user_id=user.id, first_name=first_name, last_name=last_name).first()
             if contact:
                 return contact
             else:
                 raise ContactBookException(f'Contact "{first_name}" not found.')
         else:
-            raise ContactBookException(f'User with ID {user_id} not found.')
+            raise ContactBookException('User not found.')
+
+    @staticmethod
+    @router.read
+    def find_contacts(user, query, limit=10):
+        # This static method searches the contact book of the given user by prefixes of the first name, last name and
+        # phone number, tolerating typos in the names. The search runs on an in-memory index which is built from
+        # the database on the first search and kept up to date by add_contact and delete_contact; it is rebuilt when
+        # the contacts version of the user shows a change made by another process. It returns up to limit (contact ID,
+        # first name, last name, phone number) rows.
+        if user:
+            user_id = user.id
+            version = db.session.query(User.contacts_version).filter(User.id == user_id).scalar()
+            return contact_search.search(user_id, version, query, lambda: ContactBookService.contact_rows(user_id),
+                                         limit)
+        else:
+            raise ContactBookException('User not found.')
+
+    @staticmethod
+    def contact_rows(user_id):
+        # This static method returns the (contact ID, first name, last name, phone number) rows of a user.
+        return db.session.query(ContactBook.id, ContactBook.first_name, ContactBook.last_name,
+                                ContactBook.phone_number).filter(ContactBook.user_id == user_id).all()
 
     @staticmethod
-    def delete_contact(user_id, first_name, last_name):
-        # This static method deletes a specific contact from the contact book for a user with the specified user ID,
+    def change_contact_count(user_id, delta):
+        # This static method adds delta to the contact count of the user with the given ID in the transaction of the
+        # caller, and increments the contacts version which tells the search indexes that the contacts changed.
+        User.query.filter_by(id=user_id) \
+            .update({User.contact_count: User.contact_count + delta,
+                     User.contacts_version: User.contacts_version + 1}, synchronize_session=False)
+
+    @staticmethod
+    @router.write
+    def delete_contact(user, first_name, last_name):
+        # This static method deletes a specific contact from the contact book for the given user,
         # first name and last name.
-        user = User.query.get(user_id)
         if user:
-            contact = ContactBook.query.filter_by(user_id=user_id, first_name=first_name, last_name=last_name).first()
+            contact = ContactBook.query.filter_by(user_id=user.id, first_name=first_name, last_name=last_name).first()
             if contact:
+                user_id, contact_id = user.id, contact.id
                 db.session.delete(contact)
+                ContactBookService.change_contact_count(user_id, -1)
                 db.session.commit()
+                contact_search.remove(user_id, contact_id)
                 return f"Contact '{first_name}' has been deleted."
             else:
                 raise ContactBookException(f'Contact "{first_name}" not found in your contact book.')
         else:
-            raise ContactBookException(f'User with ID {user_id} not found.')
+            raise ContactBookException('User not found.')
 
     @staticmethod
-    def add_contact(user_id, first_name, last_name, phone_number):
-        # This static method adds a new contact to the contact book for a user with the specified user ID, first name,
-        # last name and phone number.
-        user = User.query.get(user_id)
+    @router.write
+    def add_contact(user, first_name, last_name, phone_number):
+        # This static method adds a new contact to the contact book for the given user, first name,
+        # last name and phone number. An existing contact with the same name is detected by the unique constraint.
         if user:
-            contact = ContactBook.query.filter_by(user_id=user_id, first_name=first_name, last_name=last_name).first()
-            if contact:
+            user_id = user.id
+            new_contact = ContactBook(first_name=first_name,
+                                      last_name=last_name,
+                                      phone_number=phone_number,
+                                      user_id=user_id)
+            db.session.add(new_contact)
+            try:
+                db.session.flush()
+                contact_id = new_contact.id
+                ContactBookService.change_contact_count(user_id, 1)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
                 raise ContactBookException(f'Contact "{first_name}" already exists in your contact book.')
-            else:
-                new_contact = ContactBook(first_name=first_name,
-                                          last_name=last_name,
-                                          phone_number=phone_number,
-                                          user=user)
-                db.session.add(new_contact)
+            contact_search.add(user_id, contact_id, first_name, last_name, phone_number)
+            return f"Contact '{first_name}' has been added to your contact book."
+        else:
+            raise ContactBookException('User not found.')
+
+    @staticmethod
+    @router.write
+    def import_contacts(user, rows):
+        # This static method adds the (first name, last name, phone number) rows of an imported file to the contact
+        # book of the given user. The rows are consumed as a stream: names already in the contact book or earlier in
+        # the file are skipped in memory, and new contacts are inserted in chunks of CONTACTS_IMPORT_CHUNK_SIZE with
+        # one commit at the end, together with the contact count. Rows with an empty or too long value, or a phone
+        # number without digits, are invalid. It returns the numbers of imported, duplicate and invalid rows.
+        if user:
+            user_id = user.id
+            columns = ContactBook.__table__.c
+            limits = (columns.first_name.type.length, columns.last_name.type.length, columns.phone_number.type.length)
+            seen = set(db.session.query(ContactBook.first_name, ContactBook.last_name)
+                       .filter(ContactBook.user_id == user_id))
+            imported = duplicates = invalid = 0
+            chunk = []
+            try:
+                for row in rows:
+                    row = tuple(value.strip() for value in row)
+                    if len(row) != 3 or not all(row) or any(len(value) > limit for value, limit in zip(row, limits)) \
+                            or not re.search(r'\d', row[2]):
+                        invalid += 1
+                        continue
+                    first_name, last_name, phone_number = row
+                    if (first_name, last_name) in seen:
+                        duplicates += 1
+                        continue
+                    seen.add((first_name, last_name))
+                    chunk.append({'first_name': first_name, 'last_name': last_name, 'phone_number': phone_number,
+                                  'user_id': user_id})
+                    if len(chunk) >= ContactBookService.CONTACTS_IMPORT_CHUNK_SIZE:
+                        db.session.execute(ContactBook.__table__.insert(), chunk)
+                        imported += len(chunk)
+                        chunk = []
+                if chunk:
+                    db.session.execute(ContactBook.__table__.insert(), chunk)
+                    imported += len(chunk)
+                if imported:
+                    ContactBookService.change_contact_count(user_id, imported)
                 db.session.commit()
-                return f"Contact '{first_name}' has been added to your contact book."
+            except IntegrityError:
+                db.session.rollback()
+                raise ContactBookException('The contact book was changed during the import. Please try again.')
+            except (csv.Error, UnicodeDecodeError):
+                db.session.rollback()
+                raise ContactBookException('Cannot read the file. Please send a UTF-8 CSV or vCard file.')
+            if imported:
+                contact_search.invalidate(user_id)
+            return imported, duplicates, invalid
+        else:
+            raise ContactBookException('User not found.')
+
+    @staticmethod
+    @router.read
+    def export_contacts(user, contact_format):
+        # This static method writes the contact book of the given user to a temporary file in the given format. The
+        # contacts are read from the database in batches and written as they arrive, and the file only moves from
+        # memory to disk when it grows large, so big contact books are never held in memory. It returns the file,
+        # rewound, and the number of exported contacts.
+        if user:
+            rows = db.session.query(ContactBook.first_name, ContactBook.last_name, ContactBook.phone_number) \
+                .filter(ContactBook.user_id == user.id).order_by(ContactBook.id) \
+                .yield_per(ContactBookService.CONTACTS_EXPORT_BATCH_SIZE)
+            counter = {'count': 0}
+
+            def counted(rows):
+                for row in rows:
+                    counter['count'] += 1
+                    yield row
+
+            file = tempfile.SpooledTemporaryFile(max_size=ContactBookService.CONTACTS_EXPORT_MEMORY_SIZE)
+            for chunk in contact_files.serialize(counted(rows), contact_format):
+                file.write(chunk.encode())
+            if not counter['count']:
+                file.close()
+                raise ContactBookException('Your contact book is empty.')
+            file.seek(0)
+            return file, counter['count']
         else:
-            raise ContactBookException(f'User with ID {user_id} not found.')
+            raise ContactBookException('User not found.')
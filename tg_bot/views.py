@@ -1,14 +1,61 @@
 from tg_bot import app
-from flask import request
-from .handlers import MessageHandler, CallBackHandler
+from flask import request, jsonify, Response
+from . import metrics
+from .dedup import deduplicator
+from .dispatcher import UpdateDispatcher, DISPATCH_MODE
+from .handlers import WEBHOOK_REPLIES, deliver_replies, get_update_sender_id, handle_update
+from .instrumentation import command_stats
+from .routing import router
+from .scheduler import weather_alerts
+from .sender import sender
+from .services import ShopWizardService, WeatherService
+from .warmup import process_stats
+
+dispatcher = UpdateDispatcher(app, handle_update)
+
+metrics.registry.register(metrics.Gauge(
+    'tg_bot_dispatcher_queue_depth', 'Updates waiting for a dispatcher worker.',
+    lambda: dispatcher.stats()['queue_depth']))
+metrics.registry.register(metrics.Gauge(
+    'tg_bot_sender_pending', 'Queued Bot API jobs which are not delivered yet.', sender.pending))
 
 
 @app.route('/', methods=["POST"])
 def hello():
-    if message := request.json.get('message'):
-        handler = MessageHandler(message)
-    elif callback := request.json.get('callback_query'):
-        handler = CallBackHandler(callback)
-    handler.handle()
+    update = request.get_json(silent=True) or {}
+    user_id = get_update_sender_id(update)
+    if user_id is None or deduplicator.is_duplicate(update):
+        return 'ok', 200
+    if DISPATCH_MODE == 'queue':
+        dispatcher.dispatch(user_id, update)
+        return 'ok', 200
+    # The update is marked as seen before it is handled, so a concurrent redelivery is not handled twice. If the
+    # handling fails, the mark is removed and the error response makes Telegram redeliver the update.
+    try:
+        if WEBHOOK_REPLIES:
+            reply = deliver_replies(handle_update(update, collect=True))
+            if reply is not None:
+                return jsonify(reply)
+        else:
+            handle_update(update)
+    except Exception:
+        deduplicator.forget(update)
+        raise
     return 'ok', 200
 
+
+@app.route('/stats', methods=["GET"])
+def stats():
+    return jsonify(commands=command_stats.snapshot(),
+                   dispatcher=dispatcher.stats(),
+                   deduplicator=deduplicator.stats(),
+                   weather_cache=WeatherService.cache_stats(),
+                   items_cache=ShopWizardService.items_cache.stats(),
+                   replicas=router.stats(),
+                   process=process_stats(),
+                   weather_alerts=weather_alerts.stats())
+
+
+@app.route('/metrics', methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
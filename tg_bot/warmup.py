@@ -0,0 +1,118 @@
+import logging
+import os
+import resource
+import time
+
+import requests
+from sqlalchemy.pool import QueuePool
+
+from . import callback_codec, db
+from .cache import MemoryCacheBackend
+from .dedup import DatabaseSeenSet, deduplicator
+from .routing import router
+from .sender import sender
+from .services import ShopWizardService, WeatherService
+
+# Connections opened per database engine by the warm-up, at most the pool size of the engine.
+WARMUP_DB_CONNECTIONS = int(os.getenv('WARMUP_DB_CONNECTIONS', 5))
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 5))
+
+logger = logging.getLogger(__name__)
+
+# The startup timings of this process, filled in by the server hooks and reported on /stats.
+startup = {}
+
+
+def rss_bytes():
+    # Returns the resident set size of this process. It is read from /proc where available, the peak RSS reported by
+    # getrusage is used elsewhere.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def private_bytes():
+    # Returns the memory only this process uses, i.e. its RSS without the pages still shared copy-on-write with the
+    # master and the other workers, or None where /proc/self/smaps_rollup is not available.
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            return sum(int(line.split()[1]) * 1024 for line in f if line.startswith(('Private_Clean', 'Private_Dirty')))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def reset_connections(app):
+    # Drops the database connections and the HTTP keep-alive connections inherited from the parent process. It is
+    # called in every worker right after the fork, as sockets must not be shared between processes.
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    sender.session.close()
+    WeatherService.session.close()
+
+
+def warm_up(app, db_connections=WARMUP_DB_CONNECTIONS, timeout=WARMUP_TIMEOUT):
+    # Opens the database pool connections of every engine and the keep-alive connections to the Bot API and the
+    # weather APIs, so the first requests of a worker do not pay for them. A failing step is logged and skipped. It
+    # returns the time of every step in milliseconds.
+    timings = {}
+    start = time.perf_counter()
+    with app.app_context():
+        for key, engine in db.engines.items():
+            size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+            connections = []
+            try:
+                for _ in range(min(db_connections, size)):
+                    connections.append(engine.connect())
+            except Exception:
+                logger.exception('Cannot open connections of the %s database', key or 'primary')
+            finally:
+                for connection in connections:
+                    connection.close()
+    timings['db_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    start = time.perf_counter()
+    try:
+        sender.call('getMe', {}, timeout=timeout)
+    except requests.RequestException:
+        logger.warning('Cannot reach the Bot API during the warm-up')
+    timings['bot_api_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    start = time.perf_counter()
+    for url in {WeatherService.GEO_URL, WeatherService.WEATHER_URL} - {None}:
+        try:
+            WeatherService.session.head(url, timeout=timeout)
+        except requests.RequestException:
+            logger.warning('Cannot reach %s during the warm-up', url)
+    timings['weather_api_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return timings
+
+
+def process_local_settings():
+    # Returns the settings which keep state in process memory although every process serving the webhook must share
+    # it: the items cache, the callback tokens, the deduplicated update IDs and, with replicas, the write markers.
+    # Several worker processes need all of them to be set.
+    missing = []
+    if isinstance(ShopWizardService.items_cache, MemoryCacheBackend):
+        missing.append('LIST_CACHE_URL')
+    if isinstance(callback_codec.token_store, MemoryCacheBackend):
+        missing.append('CALLBACK_TOKEN_URL')
+    if not isinstance(deduplicator.seen_set, DatabaseSeenSet):
+        missing.append('DEDUP_BACKEND=db')
+    if router.keys and isinstance(router.recent_writes, MemoryCacheBackend):
+        missing.append('READ_YOUR_WRITES_URL')
+    return missing
+
+
+def process_stats():
+    # Returns the PID, the current RSS and private memory and the startup timings of this process.
+    private = private_bytes()
+    return {
+        'pid': os.getpid(),
+        'rss_mb': round(rss_bytes() / 1024 / 1024, 1),
+        'private_mb': round(private / 1024 / 1024, 1) if private is not None else None,
+        **startup,
+    }